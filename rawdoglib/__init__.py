@@ -2,4 +2,6 @@ __all__ = [
     'feedscanner',
     'persister',
     'rawdog',
+    'rendercache',
+    'sqlpersister',
     ]
@@ -0,0 +1,778 @@
+# asyncfetch: fetch feeds over HTTP using non-blocking sockets
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+"""Fetch lots of feeds at once from a single thread.
+
+Each feed's request is built and processed by the same urllib2 handlers
+that rawdog would give feedparser, so proxies, authentication, plugins'
+handlers and conditional requests all work as usual; only the transport
+(what urllib2's HTTPHandler and HTTPSHandler would do) is replaced by
+non-blocking sockets driven by asyncore. When a handler asks for another
+request to be made (to follow a redirect, or to retry with
+authentication), that request is queued rather than being made
+immediately.
+
+As each feed's response arrives, it's given to feedparser to parse, as
+if it had fetched it itself (or passed on unparsed, if the fetcher's raw
+flag is set), and the result is passed to the fetcher's output function.
+Feeds that aren't fetched over HTTP are fetched in the usual way."""
+
+from rawdoglib.httppool import get_origin, get_request_headers, make_response
+from rawdoglib.parsepool import FailedResponse, RawResponse
+from rawdoglib.plugins import call_hook
+
+import Queue
+import asyncore
+import cStringIO
+import errno
+import feedparser
+import httplib
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+try:
+	import ssl
+except ImportError:
+	ssl = None
+
+# The number of threads used to look up hostnames, since there's no way
+# to do that without blocking.
+RESOLVER_THREADS = 4
+
+# The number of threads used to parse feeds, when they're not being parsed
+# by parser processes.
+PARSER_THREADS = 2
+
+# The amount of data to read from a socket at once.
+READ_SIZE = 65536
+
+class PendingRequest:
+	"""Returned in place of a response when a urllib2 handler asks its
+	OpenerDirector to make another request. Handlers may set attributes
+	on this as they would on the response."""
+
+	def __init__(self, req):
+		self.req = req
+
+	def geturl(self):
+		return self.req.get_full_url()
+
+class BufferSocket:
+	"""Enough of a socket to let httplib parse a response that has
+	already been received."""
+
+	def __init__(self, data):
+		self.data = data
+
+	def makefile(self, *args):
+		return cStringIO.StringIO(self.data)
+
+class FetchJob:
+	"""The state of fetching a single feed."""
+
+	def __init__(self, feed, opener, logger, handlers):
+		self.feed = feed
+		self.opener = opener
+		self.logger = logger
+		self.handlers = handlers
+		self.first_pending = None
+		self.pending = None
+		self.origin = None
+		self.deadline = None
+
+def get_response_length(data, method):
+	"""Return the length of the HTTP response at the start of data if
+	it's been completely received, or None if it hasn't, or if the end
+	of the response will be shown by the connection closing."""
+	end = data.find("\r\n\r\n")
+	if end == -1:
+		return None
+	body_start = end + 4
+	lines = data[:end].split("\r\n")
+	try:
+		status = int(lines[0].split(None, 2)[1])
+	except (IndexError, ValueError):
+		return None
+	if status < 200:
+		# Informational responses can be followed by another
+		# response; let httplib deal with them.
+		return None
+	if method == "HEAD" or status in (204, 304):
+		return body_start
+
+	headers = {}
+	for line in lines[1:]:
+		(name, sep, value) = line.partition(":")
+		headers[name.strip().lower()] = value.strip()
+
+	if "chunked" in headers.get("transfer-encoding", "").lower():
+		pos = body_start
+		while True:
+			line_end = data.find("\r\n", pos)
+			if line_end == -1:
+				return None
+			try:
+				size = int(data[pos:line_end].split(";", 1)[0], 16)
+			except ValueError:
+				return None
+			pos = line_end + 2
+			if size == 0:
+				break
+			pos += size + 2
+		# Skip any trailers.
+		while True:
+			line_end = data.find("\r\n", pos)
+			if line_end == -1:
+				return None
+			elif line_end == pos:
+				return pos + 2
+			pos = line_end + 2
+
+	try:
+		length = int(headers["content-length"])
+	except (KeyError, ValueError):
+		return None
+	if len(data) < body_start + length:
+		return None
+	return body_start + length
+
+class Connection(asyncore.dispatcher):
+	"""An HTTP connection, which may be kept open after a response so
+	that it can be used for another request to the same host."""
+
+	def __init__(self, fetcher, key, addresses, socket_map, job, req):
+		asyncore.dispatcher.__init__(self, map=socket_map)
+		self.fetcher = fetcher
+		self.key = key
+		self.job = job
+		self.req = req
+		self.reused = False
+		self.inbuf = []
+		self.outbuf = ""
+		self.state = "connect"
+		self.want_read = False
+		self.touch()
+		self.addresses = list(addresses)
+		self.connect_next()
+
+	def connect_next(self):
+		"""Try to connect to the next address for the host."""
+		(family, socktype, proto, canonname, addr) = self.addresses.pop(0)
+		self.create_socket(family, socktype)
+		try:
+			self.connect(addr)
+		except socket.error, e:
+			self.connect_failed(e)
+
+	def connect_failed(self, exc):
+		if self.addresses:
+			asyncore.dispatcher.close(self)
+			self.connect_next()
+		else:
+			self.fail(urllib2.URLError(exc))
+
+	def touch(self):
+		self.last_activity = time.time()
+
+	def readable(self):
+		if self.state in ("tunnel", "receive", "idle"):
+			return True
+		return self.state == "handshake" and self.want_read
+
+	def writable(self):
+		if self.state == "connect":
+			return True
+		elif self.state == "handshake":
+			return not self.want_read
+		return self.outbuf != ""
+
+	def handle_connect(self):
+		self.touch()
+		if self.req._tunnel_host:
+			(headers, tunnel_headers) = get_request_headers(self.req, True)
+			host = self.req._tunnel_host
+			if ":" not in host:
+				host += ":%d" % httplib.HTTPS_PORT
+			self.outbuf = self.format_request("CONNECT", host,
+			                                  tunnel_headers, "1.0")
+			self.state = "tunnel"
+		elif self.req.get_type() == "https":
+			self.start_tls(self.req.get_host())
+		else:
+			self.send_request()
+
+	def format_request(self, method, selector, headers, version="1.1"):
+		lines = ["%s %s HTTP/%s" % (method, selector, version)]
+		for name, value in headers.items():
+			lines.append("%s: %s" % (name, value))
+		lines.append("")
+		lines.append("")
+		return "\r\n".join(lines)
+
+	def send_request(self):
+		"""Start sending the current request."""
+		(headers, tunnel_headers) = get_request_headers(self.req, True)
+		self.outbuf = self.format_request(self.req.get_method(),
+		                                  self.req.get_selector(),
+		                                  headers)
+		self.inbuf = []
+		self.state = "send"
+
+	def reuse(self, job, req):
+		"""Send another request over an idle connection."""
+		self.job = job
+		self.req = req
+		self.reused = True
+		self.touch()
+		self.send_request()
+
+	def start_tls(self, host):
+		if ssl is None:
+			self.fail(urllib2.URLError("HTTPS support is not available"))
+			return
+		context = self.fetcher.get_ssl_context(self.job)
+		(hostname, port) = urllib.splitport(host)
+		self.socket = context.wrap_socket(self.socket,
+		                                  server_hostname=hostname,
+		                                  do_handshake_on_connect=False)
+		self.state = "handshake"
+		self.want_read = False
+		self.do_handshake()
+
+	def do_handshake(self):
+		try:
+			self.socket.do_handshake()
+		except ssl.SSLWantReadError:
+			self.want_read = True
+			return
+		except ssl.SSLWantWriteError:
+			self.want_read = False
+			return
+		self.send_request()
+
+	def handle_write(self):
+		self.touch()
+		if self.state == "closed":
+			return
+		elif self.state == "handshake":
+			self.do_handshake()
+			return
+		try:
+			sent = self.socket.send(self.outbuf)
+		except socket.error, e:
+			if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+				return
+			if ssl is not None and isinstance(e, ssl.SSLWantWriteError):
+				return
+			raise
+		self.outbuf = self.outbuf[sent:]
+		if self.outbuf == "" and self.state == "send":
+			self.state = "receive"
+
+	def handle_read(self):
+		self.touch()
+		if self.state == "closed":
+			return
+		elif self.state == "handshake":
+			self.do_handshake()
+			return
+		while True:
+			try:
+				data = self.socket.recv(READ_SIZE)
+			except socket.error, e:
+				if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+					return
+				if ssl is not None and isinstance(e, ssl.SSLWantReadError):
+					return
+				if ssl is not None and isinstance(e, ssl.SSLError) and self.state == "receive":
+					# The server closed the connection without
+					# shutting down SSL properly, which many do;
+					# treat it as the end of the response.
+					data = ""
+				else:
+					raise
+			if data == "":
+				self.finish()
+				return
+			elif self.state == "idle":
+				# The server shouldn't send anything now.
+				self.close()
+				return
+			self.inbuf.append(data)
+			if self.state == "tunnel":
+				self.read_tunnel_response()
+				return
+			data = "".join(self.inbuf)
+			self.inbuf = [data]
+			length = get_response_length(data, self.req.get_method())
+			if length is not None:
+				self.complete(data[:length], length == len(data))
+				return
+			# An SSL socket may have more data buffered already,
+			# which select won't tell us about.
+			pending = getattr(self.socket, "pending", None)
+			if pending is None or pending() == 0:
+				return
+
+	def read_tunnel_response(self):
+		data = "".join(self.inbuf)
+		end = data.find("\r\n\r\n")
+		if end == -1:
+			return
+		self.inbuf = []
+		status_line = data.split("\r\n", 1)[0]
+		parts = status_line.split(None, 2)
+		if len(parts) < 2 or parts[1] != "200":
+			self.fail(urllib2.URLError(socket.error("Tunnel connection failed: " + " ".join(parts[1:]))))
+			return
+		self.start_tls(self.req._tunnel_host)
+
+	def handle_close(self):
+		self.finish()
+
+	def handle_error(self):
+		exc = sys.exc_info()[1]
+		if self.state == "connect":
+			self.connect_failed(exc)
+		else:
+			self.fail(urllib2.URLError(exc))
+
+	def handle_expt(self):
+		self.fail(urllib2.URLError(socket.error("Connection failed")))
+
+	def timed_out(self):
+		if self.state in ("connect", "tunnel", "handshake"):
+			self.fail(urllib2.URLError(socket.timeout("timed out")))
+		else:
+			self.fail(socket.timeout("timed out"))
+
+	def finish(self):
+		"""Handle the connection being closed by the server."""
+		if self.state in ("closed", "idle"):
+			self.close()
+		elif self.state != "receive" or self.inbuf == []:
+			self.fail(urllib2.URLError(socket.error("Connection closed")))
+		else:
+			self.complete("".join(self.inbuf), False)
+
+	def complete(self, data, keep_alive):
+		"""Handle a complete response."""
+		r = httplib.HTTPResponse(BufferSocket(data),
+		                         method=self.req.get_method())
+		self.inbuf = []
+		try:
+			r.begin()
+			body = r.read()
+		except Exception, e:
+			self.close()
+			self.fetcher.request_failed(self.job, e)
+			return
+
+		(job, req) = (self.job, self.req)
+		if keep_alive and not r.will_close:
+			self.state = "idle"
+			self.job = None
+			self.fetcher.connection_idle(self)
+		else:
+			self.close()
+		self.fetcher.request_done(job, req, make_response(req, r, body))
+
+	def fail(self, exc):
+		if self.state == "closed":
+			return
+		state = self.state
+		self.close()
+		if state == "idle":
+			return
+		elif self.reused and state in ("send", "receive") and self.inbuf == []:
+			# The server has probably closed the idle connection;
+			# try a new one.
+			self.fetcher.connect(self.job)
+		else:
+			self.fetcher.request_failed(self.job, exc)
+
+	def close(self):
+		self.state = "closed"
+		self.fetcher.connection_closed(self)
+		asyncore.dispatcher.close(self)
+
+class Resolver:
+	"""Look up hostnames using a pool of threads. Results are collected
+	by calling get_results."""
+
+	def __init__(self, num_threads):
+		self.requests = Queue.Queue()
+		self.results = Queue.Queue()
+		self.num_threads = num_threads
+		self.threads = []
+
+	def lookup(self, key, host, port):
+		if len(self.threads) < self.num_threads:
+			t = threading.Thread(target=self.worker)
+			t.setDaemon(True)
+			t.start()
+			self.threads.append(t)
+		self.requests.put((key, host, port))
+
+	def worker(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+			(key, host, port) = request
+			try:
+				result = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+			except socket.error, e:
+				result = e
+			self.results.put((key, result))
+
+	def get_results(self):
+		"""Return a list of (key, result) for the lookups that have
+		finished, where result is a list of addresses or an
+		exception."""
+		results = []
+		while True:
+			try:
+				results.append(self.results.get_nowait())
+			except Queue.Empty:
+				return results
+
+	def stop(self):
+		for t in self.threads:
+			self.requests.put(None)
+		for t in self.threads:
+			t.join()
+
+class Parser:
+	"""Parse fetched feeds using a pool of threads, so that parsing a
+	large feed doesn't hold up the connections that are still in
+	progress. Each result is passed to output as soon as it's ready."""
+
+	def __init__(self, num_threads, output):
+		self.requests = Queue.Queue()
+		self.num_threads = num_threads
+		self.output = output
+		self.threads = []
+
+	def parse(self, url, feed, source, logger, handlers):
+		if len(self.threads) < self.num_threads:
+			t = threading.Thread(target=self.worker)
+			t.setDaemon(True)
+			t.start()
+			self.threads.append(t)
+		self.requests.put((url, feed, source, logger, handlers))
+
+	def worker(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+			(url, feed, source, logger, handlers) = request
+			self.output(url, feed.parse(source, logger, handlers))
+
+	def stop(self):
+		"""Wait for all the feeds to be parsed."""
+		for t in self.threads:
+			self.requests.put(None)
+		for t in self.threads:
+			t.join()
+
+class AsyncFeedFetcher:
+	"""Class that will handle fetching a set of feeds concurrently
+	using non-blocking I/O."""
+
+	def __init__(self, rawdog, feedlist, config, output, raw=False):
+		self.rawdog = rawdog
+		self.config = config
+		self.output = output
+		self.raw = raw
+		self.jobs = list(feedlist)
+		self.deadline = None
+		self.start_times = {}
+		self.active = {}
+		self.connections = set()
+		self.socket_map = {}
+		self.resolver = Resolver(RESOLVER_THREADS)
+		self.parser = Parser(PARSER_THREADS, output)
+		self.addresses = {}
+		self.idle = {}
+		self.host_busy = {}
+		self.host_waiting = {}
+		self.ssl_contexts = {}
+
+	def start_feed(self, url):
+		"""Start fetching a feed."""
+		rawdog = self.rawdog
+		config = self.config
+		feed = rawdog.feeds[url]
+
+		config.log("Fetching feed: ", url)
+		self.start_times[url] = time.time()
+		call_hook("pre_update_feed", rawdog, config, feed)
+		(logger, handlers) = feed.get_handlers(rawdog, config)
+		fetch_url = feed.get_fetch_url()
+		if urllib.splittype(fetch_url)[0] not in ("http", "https"):
+			# Fetch it in the usual way.
+			if self.raw:
+				self.output(url, feed.fetch_raw(logger, handlers))
+			else:
+				self.parser.parse(url, feed, fetch_url, logger, handlers)
+			return
+
+		req = feed.make_request()
+		opener = urllib2.build_opener(*tuple(handlers + [feedparser._FeedURLHandler()]))
+		opener.addheaders = []
+		# Rather than letting handlers make further requests
+		# themselves, queue them.
+		def defer(req, data=None, timeout=None):
+			if isinstance(req, basestring):
+				req = urllib2.Request(req, data)
+			return PendingRequest(req)
+		opener.open = defer
+
+		job = FetchJob(feed, opener, logger, handlers)
+		self.active[url] = job
+		self.start_request(job, req)
+
+	def start_request(self, job, req):
+		"""Process a request using the urllib2 handlers, and start
+		sending it."""
+		opener = job.opener
+		req.timeout = self.config["timeout"]
+		try:
+			protocol = req.get_type()
+			for processor in opener.process_request.get(protocol, []):
+				req = getattr(processor, protocol + "_request")(req)
+
+			# Give handlers such as ProxyHandler a chance to
+			# change the request, stopping before the handler
+			# that would actually open the connection.
+			for kind in ("default", protocol):
+				for handler in opener.handle_open.get(kind, []):
+					if isinstance(handler, (urllib2.HTTPHandler, urllib2.HTTPSHandler)):
+						continue
+					response = getattr(handler, kind + "_open")(req)
+					if isinstance(response, PendingRequest):
+						self.start_request(job, response.req)
+						return
+					elif response is not None:
+						self.request_done(job, req, response)
+						return
+
+			protocol = req.get_type()
+			if protocol not in ("http", "https"):
+				raise urllib2.URLError("unknown url type: %s" % protocol)
+			(host, port) = urllib.splitport(req.get_host())
+			if port is None:
+				if protocol == "https":
+					port = httplib.HTTPS_PORT
+				else:
+					port = httplib.HTTP_PORT
+			if not host:
+				raise urllib2.URLError("no host given")
+			port = int(port)
+		except Exception, e:
+			self.request_failed(job, e)
+			return
+
+		context = None
+		if protocol == "https":
+			context = self.get_ssl_context(job)
+		key = (protocol, host, port, req._tunnel_host, id(context))
+		job.pending = (req, key, host, port)
+
+		origin = get_origin(req)
+		limit = self.config["hostconnections"]
+		if limit > 0 and self.host_busy.get(origin, 0) >= limit:
+			job.deadline = None
+			self.host_waiting.setdefault(origin, []).append(job)
+		else:
+			self.dispatch(job, origin)
+
+	def dispatch(self, job, origin):
+		"""Start sending a request, once it's allowed to be made to
+		its host."""
+		self.host_busy[origin] = self.host_busy.get(origin, 0) + 1
+		job.origin = origin
+		job.deadline = time.time() + self.config["timeout"]
+
+		(req, key, host, port) = job.pending
+		idle = self.idle.get(key)
+		if idle:
+			idle.pop().reuse(job, req)
+		elif (host, port) in self.addresses:
+			self.connect(job)
+		else:
+			self.resolver.lookup(job.feed.url, host, port)
+
+	def release(self, job):
+		"""Allow another request to be made to the host that job's
+		request was made to."""
+		origin = job.origin
+		if origin is None:
+			return
+		job.origin = None
+		self.host_busy[origin] -= 1
+		waiting = self.host_waiting.get(origin)
+		if waiting:
+			self.dispatch(waiting.pop(0), origin)
+
+	def host_found(self, job, result):
+		"""Connect to a host once its address is known."""
+		if isinstance(result, Exception):
+			self.request_failed(job, urllib2.URLError(result))
+			return
+		(req, key, host, port) = job.pending
+		self.addresses[(host, port)] = result
+		self.connect(job)
+
+	def connect(self, job):
+		"""Make a new connection for a request."""
+		(req, key, host, port) = job.pending
+		conn = Connection(self, key, self.addresses[(host, port)],
+		                  self.socket_map, job, req)
+		if conn.state != "closed":
+			self.connections.add(conn)
+
+	def get_ssl_context(self, job):
+		"""Return the SSL context to use for a feed: the one from its
+		HTTPSHandler if it has one, or the default."""
+		context = None
+		for handler in job.opener.handlers:
+			if isinstance(handler, urllib2.HTTPSHandler):
+				context = getattr(handler, "_context", None)
+		if context is None:
+			context = self.ssl_contexts.get(None)
+			if context is None:
+				context = ssl._create_default_https_context()
+				self.ssl_contexts[None] = context
+		return context
+
+	def connection_closed(self, conn):
+		self.connections.discard(conn)
+		idle = self.idle.get(conn.key)
+		if idle and conn in idle:
+			idle.remove(conn)
+
+	def connection_idle(self, conn):
+		self.idle.setdefault(conn.key, []).append(conn)
+
+	def request_done(self, job, req, response):
+		"""Process a response using the urllib2 handlers."""
+		self.release(job)
+		opener = job.opener
+		try:
+			protocol = req.get_type()
+			for processor in opener.process_response.get(protocol, []):
+				response = getattr(processor, protocol + "_response")(req, response)
+		except Exception, e:
+			self.request_failed(job, e)
+			return
+
+		if isinstance(response, PendingRequest):
+			# A handler wants to make another request.
+			if job.first_pending is None:
+				job.first_pending = response
+			self.start_request(job, response.req)
+			return
+
+		# Handlers that follow redirects label the final response
+		# with the status of the first redirect.
+		pending = job.first_pending
+		if pending is not None and hasattr(pending, "status"):
+			response.status = pending.status
+			response.newurl = pending.newurl
+		self.finish_job(job, response)
+
+	def request_failed(self, job, exc):
+		self.release(job)
+		self.finish_job(job, FailedResponse(exc))
+
+	def finish_job(self, job, response):
+		url = job.feed.url
+		if url not in self.active:
+			return
+		del self.active[url]
+
+		if not self.raw:
+			# Parse it in another thread, so the other
+			# connections aren't held up.
+			self.parser.parse(url, job.feed, response, job.logger, job.handlers)
+			return
+
+		if isinstance(response, FailedResponse):
+			result = (response, job.logger.get_log())
+		else:
+			try:
+				response = RawResponse(response)
+			except Exception, e:
+				response = FailedResponse(e)
+			result = (response, job.logger.get_log())
+		self.output(url, result)
+
+	def stop(self):
+		"""Don't start fetching any more feeds. This may be called from
+		another thread."""
+		self.jobs = []
+
+	def run(self, max_connections):
+		config = self.config
+		max_connections = max(max_connections, 1)
+		self.config.log("Fetching ", len(self.jobs), " feeds using up to ",
+		                max_connections, " connections")
+
+		while self.jobs or self.active:
+			if self.deadline is not None and time.time() >= self.deadline:
+				# Out of time; don't start any more.
+				self.jobs = []
+			while self.jobs and len(self.active) < max_connections:
+				self.start_feed(self.jobs.pop(0))
+
+			for (url, result) in self.resolver.get_results():
+				job = self.active.get(url)
+				if job is not None:
+					self.host_found(job, result)
+
+			if self.socket_map:
+				asyncore.loop(timeout=0.1, map=self.socket_map, count=1)
+			elif self.active:
+				# Waiting for hostnames to be looked up.
+				time.sleep(0.01)
+
+			now = time.time()
+			busy = set()
+			for conn in list(self.connections):
+				if conn.state == "idle":
+					continue
+				busy.add(conn.job)
+				if now - conn.last_activity > config["timeout"]:
+					conn.timed_out()
+			for job in self.active.values():
+				if (job not in busy and job.deadline is not None
+				    and now > job.deadline):
+					# The hostname lookup is taking too long.
+					self.request_failed(job, urllib2.URLError(socket.timeout("timed out")))
+		self.resolver.stop()
+		for conn in list(self.connections):
+			conn.close()
+		self.parser.stop()
+		self.config.log("Fetch complete")
@@ -0,0 +1,152 @@
+# daemon: run rawdog as a long-running process
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+import errno
+import fcntl
+import os
+import signal
+import time
+
+# The name of the daemon's pidfile, in the state directory.
+PIDFILE = "rawdog.pid"
+
+# The longest time the daemon will sleep for before checking whether any
+# feeds need updating.
+MAX_SLEEP = 5 * 60
+
+class PidFile:
+	"""A file containing the daemon's process ID. It's kept locked for
+	as long as the daemon is running, so other instances of rawdog can
+	tell whether it's there."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = None
+
+	def acquire(self):
+		"""Lock the file and write this process's ID to it. Return
+		False if another process already has it locked."""
+		f = open(self.filename, "a+")
+		try:
+			fcntl.lockf(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError, e:
+			f.close()
+			if e.errno in (errno.EACCES, errno.EAGAIN):
+				return False
+			raise e
+		f.seek(0)
+		f.truncate()
+		f.write("%d\n" % os.getpid())
+		f.flush()
+		self.f = f
+		return True
+
+	def release(self):
+		"""Remove the file and unlock it."""
+		try:
+			os.unlink(self.filename)
+		except OSError:
+			pass
+		self.f.close()
+		self.f = None
+
+def get_daemon_pid(filename):
+	"""If a daemon is running with the given pidfile, return its process
+	ID; otherwise, return None."""
+	try:
+		f = open(filename, "r")
+	except IOError:
+		return None
+	try:
+		try:
+			fcntl.lockf(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+		except IOError, e:
+			if e.errno in (errno.EACCES, errno.EAGAIN):
+				try:
+					return int(f.read().strip())
+				except ValueError:
+					return 0
+			raise e
+		# The lock isn't held, so the daemon isn't running.
+		return None
+	finally:
+		f.close()
+
+class Daemon:
+	"""Keep the state loaded, and repeatedly update the feeds that need
+	updating and write the output.
+
+	Sending the process SIGHUP makes it reload its config files; SIGTERM
+	or SIGINT makes it stop once it's finished what it's doing."""
+
+	def __init__(self, rawdog, config, persister, reload_config):
+		self.rawdog = rawdog
+		self.config = config
+		self.persister = persister
+		self.reload_config = reload_config
+		self.reload_requested = False
+		self.stop_requested = False
+
+	def handle_hup(self, signum, frame):
+		self.reload_requested = True
+
+	def handle_stop(self, signum, frame):
+		self.stop_requested = True
+
+	def get_wake_time(self, last_update):
+		"""Return the time when the next feed needs updating, but no
+		sooner than daemoninterval after the last update."""
+		now = time.time()
+		wake = now + MAX_SLEEP
+		for feed in self.rawdog.feeds.values():
+			wake = min(wake, feed.get_next_update())
+		return max(wake, last_update + self.config["daemoninterval"])
+
+	def run(self):
+		config = self.config
+		signal.signal(signal.SIGHUP, self.handle_hup)
+		signal.signal(signal.SIGTERM, self.handle_stop)
+		signal.signal(signal.SIGINT, self.handle_stop)
+
+		config.log("Running as a daemon")
+		need_write = True
+		while not self.stop_requested:
+			if self.reload_requested:
+				self.reload_requested = False
+				self.reload_config()
+				need_write = True
+
+			last_update = time.time()
+			if self.rawdog.update(config):
+				need_write = True
+			if need_write:
+				self.rawdog.write(config)
+				need_write = False
+
+			# Save the state while we're waiting for the next
+			# update.
+			self.persister.save_in_background()
+
+			wake = self.get_wake_time(last_update)
+			while not (self.stop_requested or self.reload_requested):
+				now = time.time()
+				if now >= wake:
+					break
+				# This is interrupted by signals.
+				time.sleep(wake - now)
+		config.log("Daemon stopping")
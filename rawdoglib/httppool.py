@@ -0,0 +1,186 @@
+# httppool: reuse HTTP connections when fetching feeds
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+import cStringIO
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+
+def get_request_headers(req, keep_alive):
+	"""Return the headers to send for a urllib2 Request, and the headers
+	to send to the proxy when opening a tunnel, in the same way as
+	urllib2's AbstractHTTPHandler.do_open. If keep_alive is False, ask
+	the server to close the connection after the response."""
+	headers = dict(req.unredirected_hdrs)
+	headers.update(dict((k, v) for k, v in req.headers.items()
+	                           if k not in headers))
+	if not keep_alive:
+		headers["Connection"] = "close"
+	headers = dict((name.title(), val) for name, val in headers.items())
+	tunnel_headers = {}
+	if req._tunnel_host:
+		proxy_auth_hdr = "Proxy-Authorization"
+		if proxy_auth_hdr in headers:
+			tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+	return (headers, tunnel_headers)
+
+def get_origin(req):
+	"""Return the host that a request will eventually be made to, even
+	if it goes through a proxy."""
+	return urlparse.urlsplit(req.get_full_url()).netloc.lower()
+
+def make_response(req, r, body):
+	"""Return a urllib2 response for an httplib response, whose body has
+	already been read."""
+	resp = urllib.addinfourl(cStringIO.StringIO(body), r.msg,
+	                         req.get_full_url(), r.status)
+	resp.msg = r.reason
+	return resp
+
+class HostLimiter:
+	"""Limit the number of requests being made to each host at once.
+	If limit is 0, there's no limit."""
+
+	def __init__(self, limit):
+		self.limit = limit
+		self.cond = threading.Condition()
+		self.busy = {}
+
+	def acquire(self, host):
+		with self.cond:
+			while self.limit > 0 and self.busy.get(host, 0) >= self.limit:
+				self.cond.wait()
+			self.busy[host] = self.busy.get(host, 0) + 1
+
+	def release(self, host):
+		with self.cond:
+			self.busy[host] -= 1
+			if self.busy[host] == 0:
+				del self.busy[host]
+			self.cond.notifyAll()
+
+class ConnectionPool:
+	"""A collection of open HTTP connections, which can be shared by
+	several threads. Connections are kept open after each request, so
+	they can be reused by later requests to the same host (through the
+	same proxy); the number of requests being made to each host at once
+	is limited."""
+
+	def __init__(self, host_limit):
+		self.lock = threading.Lock()
+		self.idle = {}
+		self.limiter = HostLimiter(host_limit)
+
+	def get_connection(self, key):
+		"""Return an idle connection for key, or None if there isn't
+		one."""
+		with self.lock:
+			conns = self.idle.get(key)
+			if conns:
+				return conns.pop()
+		return None
+
+	def put_connection(self, key, conn):
+		"""Return a connection to the pool once it's idle."""
+		with self.lock:
+			self.idle.setdefault(key, []).append(conn)
+
+	def open(self, req, http_class, **http_conn_args):
+		"""Make a request using a pooled connection, and return a
+		urllib2 response. The response's body is read immediately, so
+		that the connection can be reused."""
+		host = req.get_host()
+		if not host:
+			raise urllib2.URLError("no host given")
+
+		key = (http_class, host, req._tunnel_host,
+		       id(http_conn_args.get("context")))
+		(headers, tunnel_headers) = get_request_headers(req, True)
+
+		origin = get_origin(req)
+		self.limiter.acquire(origin)
+		try:
+			while True:
+				h = self.get_connection(key)
+				reused = h is not None
+				if h is None:
+					h = http_class(host, timeout=req.timeout, **http_conn_args)
+					if req._tunnel_host:
+						h.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+				elif req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+					h.sock.settimeout(req.timeout)
+
+				try:
+					h.request(req.get_method(), req.get_selector(), req.data, headers)
+					r = h.getresponse(buffering=True)
+				except (socket.error, httplib.HTTPException), err:
+					h.close()
+					if reused:
+						# The server has probably closed the
+						# idle connection; try a new one.
+						continue
+					raise urllib2.URLError(err)
+				break
+
+			try:
+				body = r.read()
+			except:
+				h.close()
+				raise
+			if r.will_close:
+				h.close()
+			else:
+				self.put_connection(key, h)
+		finally:
+			self.limiter.release(origin)
+
+		return make_response(req, r, body)
+
+	def close(self):
+		"""Close all the idle connections."""
+		with self.lock:
+			for conns in self.idle.values():
+				for h in conns:
+					h.close()
+			self.idle = {}
+
+class PooledHTTPHandler(urllib2.HTTPHandler):
+	"""urllib2 handler that makes HTTP requests using a
+	ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib2.HTTPHandler.__init__(self)
+		self.pool = pool
+
+	def http_open(self, req):
+		return self.pool.open(req, httplib.HTTPConnection)
+
+class PooledHTTPSHandler(urllib2.HTTPSHandler):
+	"""urllib2 handler that makes HTTPS requests using a
+	ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib2.HTTPSHandler.__init__(self)
+		self.pool = pool
+
+	def https_open(self, req):
+		return self.pool.open(req, httplib.HTTPSConnection,
+		                      context=self._context)
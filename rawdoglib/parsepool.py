@@ -0,0 +1,181 @@
+# parsepool: parse feeds in a pool of worker processes
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+import Queue
+import StringIO
+import multiprocessing
+import threading
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+class RawResponse:
+	"""The parts of a urllib2 response that feedparser looks at, in a
+	form that can be sent to another process."""
+
+	def __init__(self, response):
+		self.data = response.read()
+		self.attrs = {}
+		if hasattr(response, "headers"):
+			self.attrs["headers"] = dict(response.headers)
+		for name in ("url", "status", "code"):
+			if hasattr(response, name):
+				self.attrs[name] = getattr(response, name)
+		if hasattr(response, "close"):
+			response.close()
+
+	def open(self):
+		"""Return a file-like object that feedparser can parse as if it
+		were the original response."""
+		f = StringIO.StringIO(self.data)
+		for name, value in self.attrs.items():
+			setattr(f, name, value)
+		return f
+
+class FailedResponse:
+	"""Stands in for a response that couldn't be fetched. Reading it
+	raises the exception, so that feedparser reports it in the same way
+	as if it had fetched the feed itself."""
+
+	def __init__(self, exc):
+		self.exc = exc
+
+	def read(self, *args):
+		raise self.exc
+
+def get_cpu_time():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+def limit_cpu_time(seconds):
+	"""Arrange for this process to be killed with SIGXCPU if it uses
+	more than seconds more CPU time."""
+	(soft, hard) = resource.getrlimit(resource.RLIMIT_CPU)
+	limit = int(get_cpu_time()) + 1 + seconds
+	if hard != resource.RLIM_INFINITY and limit > hard:
+		limit = hard
+	resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+def worker_main(conn, func, cpu_limit):
+	"""Call func on each task received from conn, and send back the
+	results."""
+	while True:
+		task = conn.recv()
+		if task is None:
+			break
+		if cpu_limit > 0 and resource is not None:
+			limit_cpu_time(cpu_limit)
+		try:
+			result = ("ok", func(task))
+		except Exception, e:
+			result = ("error", str(e))
+		try:
+			conn.send(result)
+		except Exception, e:
+			# The result couldn't be pickled.
+			conn.send(("error", str(e)))
+	conn.close()
+
+class Worker:
+	"""A worker process."""
+
+	def __init__(self, func, cpu_limit):
+		(self.conn, child_conn) = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=worker_main,
+		                                       args=(child_conn, func, cpu_limit))
+		self.process.daemon = True
+		self.process.start()
+		child_conn.close()
+
+	def call(self, task):
+		"""Send a task to the worker, and return the result."""
+		self.conn.send(task)
+		try:
+			return self.conn.recv()
+		except EOFError:
+			# The worker's died, probably because it ran out of
+			# CPU time.
+			self.process.join()
+			self.conn.close()
+			return ("died", self.process.exitcode)
+
+	def stop(self):
+		try:
+			self.conn.send(None)
+		except IOError:
+			pass
+		self.process.join()
+		self.conn.close()
+
+class ParserPool:
+	"""A pool of worker processes that call func on tasks, so that
+	parsing feeds can use more than one CPU. Each task may use up to
+	cpu_limit seconds of CPU time (if cpu_limit isn't 0); a worker that
+	takes longer is killed and replaced.
+
+	Tasks are given to the pool using put, and output(key, result) is
+	called from one of the pool's threads as each one finishes. The
+	result is ("ok", value) if func returned value, ("error", message)
+	if it raised an exception, or ("died", exitcode) if the worker
+	process died."""
+
+	def __init__(self, num_workers, func, cpu_limit, output):
+		num_workers = max(num_workers, 1)
+		self.func = func
+		self.cpu_limit = cpu_limit
+		self.output = output
+		self.tasks = Queue.Queue(num_workers)
+		self.threads = []
+		for i in range(num_workers):
+			t = threading.Thread(target=self.thread_main)
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+
+	def thread_main(self):
+		# Each thread looks after one worker process, which isn't
+		# started until it's needed.
+		worker = None
+		while True:
+			item = self.tasks.get()
+			if item is None:
+				break
+			(key, task) = item
+			if worker is None:
+				worker = Worker(self.func, self.cpu_limit)
+			result = worker.call(task)
+			if result[0] == "died":
+				worker = None
+			self.output(key, result)
+		if worker is not None:
+			worker.stop()
+
+	def put(self, key, task):
+		"""Add a task to the queue. This blocks if all the workers are
+		busy and there are already enough tasks waiting."""
+		self.tasks.put((key, task))
+
+	def close(self):
+		"""Wait for the remaining tasks to finish, and stop the
+		workers."""
+		for t in self.threads:
+			self.tasks.put(None)
+		for t in self.threads:
+			t.join()
@@ -21,6 +21,7 @@ import errno
 import fcntl
 import os
 import sys
+import threading
 
 class Persistable:
 	"""An object which can be persisted."""
@@ -35,9 +36,27 @@ class Persistable:
 	def is_modified(self):
 		return self._modified
 
+	def get_changes(self):
+		"""Return a list of records describing how the object has been
+		modified since it was loaded or last saved, which can be passed
+		to apply_change to bring an older copy of the object up to
+		date -- or None if the changes can't be described that way, in
+		which case the whole object must be saved."""
+		return None
+
+	def apply_change(self, change):
+		"""Apply a change record returned by get_changes."""
+		raise ValueError("Unknown change record: " + repr(change))
+
 class Persisted:
 	"""Context manager for a persistent object.  The object being persisted
-	must implement the Persistable interface."""
+	must implement the Persistable interface.
+
+	If the persister is using a journal, then changes to the object are
+	appended to filename.journal rather than rewriting the whole file
+	each time it's saved, and the journal is replayed when the object is
+	loaded. Once the journal gets too big, it's folded back into the
+	file."""
 
 	def __init__(self, klass, filename, persister):
 		self.klass = klass
@@ -46,13 +65,16 @@ class Persisted:
 		self.lock_file = None
 		self.object = None
 		self.refcount = 0
+		self.have_snapshot = False
+		self.journal_size = 0
+		self.writer = None
 
 	def rename(self, new_filename):
 		"""Rename the persisted file. This works whether the file is
 		currently open or not."""
 
 		self.persister._rename(self.filename, new_filename)
-		for ext in ("", ".lock"):
+		for ext in ("", ".lock", ".journal"):
 			try:
 				os.rename(self.filename + ext,
 				          new_filename + ext)
@@ -92,13 +114,17 @@ class Persisted:
 		except KeyboardInterrupt:
 			sys.exit(1)
 		except:
-			print "An error occurred while reading state from " + os.path.abspath(self.filename) + "."
+			print "An error occurred while reading state from " + self.get_path() + "."
 			print "This usually means the file is corrupt, and removing it will fix the problem."
 			sys.exit(1)
 
 		self.refcount = 1
 		return self.object
 
+	def get_path(self):
+		"""Return the full path of the file the object is stored in."""
+		return os.path.abspath(self.filename)
+
 	def _get_lock(self, no_block):
 		if not self.persister.use_locking:
 			return True
@@ -126,14 +152,84 @@ class Persisted:
 		except IOError:
 			# File can't be opened.
 			# Create a new object.
+			self.have_snapshot = False
 			self.object = self.klass()
 			self.object.modified()
 			return
 
+		self.have_snapshot = True
 		self.object = pickle.load(f)
+		f.close()
+		self._replay_journal()
 		self.object.modified(False)
+
+	def _replay_journal(self):
+		"""Apply the changes recorded in the journal, if there is one.
+		This is done even if the persister isn't using a journal now, in
+		case it was the last time the object was saved."""
+
+		self.journal_size = 0
+		try:
+			f = open(self.filename + ".journal", "rb")
+		except IOError:
+			return
+
+		self.persister.log("Replaying journal: ", self.filename)
+		while True:
+			try:
+				changes = pickle.load(f)
+			except EOFError:
+				break
+			except Exception:
+				# rawdog was interrupted while it was writing
+				# this record. Throw it away, so that the next
+				# record is written in the right place.
+				self.persister.log("Discarding incomplete journal record: ", self.filename)
+				f.close()
+				f = open(self.filename + ".journal", "r+b")
+				f.truncate(self.journal_size)
+				break
+			for change in changes:
+				self.object.apply_change(change)
+			self.journal_size = f.tell()
 		f.close()
 
+	def checkpoint(self):
+		"""If the persister is using a journal, save any changes that
+		have been made to the object so far, so that they won't be lost
+		if rawdog is interrupted before the object is closed."""
+
+		if self.refcount == 0 or not self.persister.use_journal:
+			return
+		if self.object.is_modified():
+			self._save()
+
+	def save_in_background(self):
+		"""Save the object if it's been modified, without waiting for
+		it to be written out if possible. The object is pickled
+		straight away, so it can be changed again as soon as this
+		returns."""
+
+		if self.refcount == 0 or not self.object.is_modified():
+			return
+		if self.persister.use_journal:
+			# Appending to the journal is quick anyway.
+			self._save()
+			return
+
+		self.wait()
+		self.persister.log("Saving state file in the background: ", self.filename)
+		data = pickle.dumps(self.object, pickle.HIGHEST_PROTOCOL)
+		self.object.modified(False)
+		self.writer = threading.Thread(target=self._write_snapshot, args=(data,))
+		self.writer.start()
+
+	def wait(self):
+		"""Wait for a background save to finish."""
+		if self.writer is not None:
+			self.writer.join()
+			self.writer = None
+
 	def close(self):
 		"""Reduce the reference count of the persisted object, saving
 		it back to its file if necessary."""
@@ -143,25 +239,74 @@ class Persisted:
 			# Still in use.
 			return
 
+		self.wait()
+
 		if self.object.is_modified():
-			self.persister.log("Saving state file: ", self.filename)
-			newname = "%s.new-%d" % (self.filename, os.getpid())
-			newfile = open(newname, "w")
-			pickle.dump(self.object, newfile, pickle.HIGHEST_PROTOCOL)
-			newfile.close()
-			os.rename(newname, self.filename)
+			self._save()
 
 		if self.lock_file is not None:
 			self.lock_file.close()
 		self.persister._remove(self.filename)
 
+	def _save(self):
+		changes = None
+		if (self.persister.use_journal
+		    and self.have_snapshot
+		    and self.journal_size < self.persister.journal_size):
+			changes = self.object.get_changes()
+		self.object.modified(False)
+
+		if changes is None:
+			self._save_snapshot()
+		else:
+			self._append_journal(changes)
+
+	def _save_snapshot(self):
+		self.persister.log("Saving state file: ", self.filename)
+		newname = "%s.new-%d" % (self.filename, os.getpid())
+		newfile = open(newname, "w")
+		pickle.dump(self.object, newfile, pickle.HIGHEST_PROTOCOL)
+		newfile.close()
+		self._replace_snapshot(newname)
+
+	def _write_snapshot(self, data):
+		"""Write an already-pickled object to the file."""
+		newname = "%s.new-%d" % (self.filename, os.getpid())
+		newfile = open(newname, "w")
+		newfile.write(data)
+		newfile.close()
+		self._replace_snapshot(newname)
+
+	def _replace_snapshot(self, newname):
+		os.rename(newname, self.filename)
+		self.have_snapshot = True
+
+		# The journal's now included in the file.
+		try:
+			os.unlink(self.filename + ".journal")
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise e
+		self.journal_size = 0
+
+	def _append_journal(self, changes):
+		self.persister.log("Appending to journal: ", self.filename)
+		f = open(self.filename + ".journal", "ab")
+		pickle.dump(changes, f, pickle.HIGHEST_PROTOCOL)
+		self.journal_size = f.tell()
+		f.close()
+
 class Persister:
 	"""Manage the collection of persisted files."""
 
+	persisted_class = Persisted
+
 	def __init__(self, config):
 		self.files = {}
 		self.log = config.log
 		self.use_locking = config.locking
+		self.use_journal = (config["statebackend"] == "journal")
+		self.journal_size = config["journalsize"]
 
 	def get(self, klass, filename):
 		"""Get a context manager for a persisted file.
@@ -171,7 +316,7 @@ class Persister:
 		if filename in self.files:
 			return self.files[filename]
 
-		p = Persisted(klass, filename, self)
+		p = self.persisted_class(klass, filename, self)
 		self.files[filename] = p
 		return p
 
@@ -182,10 +327,22 @@ class Persister:
 	def _remove(self, filename):
 		del self.files[filename]
 
+	def checkpoint(self):
+		"""Save the changes made so far to all the open objects, if the
+		persister is using a journal."""
+		for p in self.files.values():
+			p.checkpoint()
+
+	def save_in_background(self):
+		"""Save all the open objects that have been modified, without
+		waiting for them to be written out if possible."""
+		for p in self.files.values():
+			p.save_in_background()
+
 	def delete(self, filename):
-		"""Delete a persisted file, along with its lock file,
-		if they exist."""
-		for ext in ("", ".lock"):
+		"""Delete a persisted file, along with its lock and journal
+		files, if they exist."""
+		for ext in ("", ".lock", ".journal"):
 			try:
 				os.unlink(filename + ext)
 			except OSError:
@@ -30,8 +30,12 @@ class Box:
 		self.value = value
 
 plugin_count = 0
+loaded_files = set()
 
 def load_plugins(dir, config):
+	"""Load the plugins in a directory. Plugins that have already been
+	loaded (for example, when the config file is reloaded) are
+	skipped."""
 	global plugin_count
 
 	try:
@@ -52,6 +56,9 @@ def load_plugins(dir, config):
 			continue
 
 		fn = os.path.join(dir, file)
+		if os.path.abspath(fn) in loaded_files:
+			continue
+		loaded_files.add(os.path.abspath(fn))
 		config.log("Loading plugin ", fn)
 		f = open(fn, "r")
 		imp.load_module("plugin%d" % (plugin_count,), f, fn, desc)
@@ -20,26 +20,40 @@ VERSION = "2.22rc1"
 HTTP_AGENT = "rawdog/" + VERSION
 STATE_VERSION = 2
 
+from rawdoglib.asyncfetch import AsyncFeedFetcher
+from rawdoglib.daemon import PIDFILE, Daemon, PidFile, get_daemon_pid
 import rawdoglib.feedscanner
+from rawdoglib.httppool import ConnectionPool, PooledHTTPHandler, PooledHTTPSHandler
+from rawdoglib.parsepool import FailedResponse, ParserPool, RawResponse
 from rawdoglib.persister import Persistable, Persister
-from rawdoglib.plugins import Box, call_hook, load_plugins
+from rawdoglib.plugins import Box, attached, call_hook, load_plugins
+from rawdoglib.rendercache import OutputRecord, RenderCache
+from rawdoglib.seenfilter import SeenFilter
+import rawdoglib.simhash
 
 from cStringIO import StringIO
+import Queue
 import base64
+import cPickle as pickle
 import calendar
 import cgi
+import email.utils
 import feedparser
 import getopt
 import hashlib
+import heapq
 import locale
 import os
+import random
 import re
+import signal
 import socket
 import string
 import sys
 import threading
 import time
 import types
+import urllib
 import urllib2
 import urlparse
 
@@ -53,6 +67,11 @@ try:
 except:
 	mxtidy = None
 
+try:
+	from rawdoglib.sqlpersister import SQLitePersister
+except ImportError:
+	SQLitePersister = None
+
 # Turn off content-cleaning, since we want to see an approximation to the
 # original content for hashing. rawdog will sanitise HTML when writing.
 feedparser.RESOLVE_RELATIVE_URIS = 0
@@ -66,6 +85,17 @@ feedparser.PARSE_MICROFORMATS = 0
 # This is initialised in main().
 persister = None
 
+# This is set while feeds are being fetched.
+connection_pool = None
+
+# These are set while the output is being written, if the render cache is
+# in use.
+render_cache = None
+render_fingerprint = None
+
+# Feeds' template bits, cached while the output is being written.
+feed_bits_cache = {}
+
 system_encoding = None
 def get_system_encoding():
 	"""Get the system encoding."""
@@ -246,7 +276,115 @@ def string_to_html(s, config):
 	"""Convert a string to HTML."""
 	return sanitise_html(cgi.escape(s), "", True, config)
 
+def hash_value(h, value):
+	"""Add a structure returned by feedparser to a hashlib object."""
+	if isinstance(value, dict):
+		for k in sorted(value.keys()):
+			hash_value(h, k)
+			hash_value(h, value[k])
+	elif isinstance(value, (list, tuple)):
+		for v in value:
+			hash_value(h, v)
+	elif isinstance(value, unicode):
+		h.update(value.encode("UTF-8"))
+	else:
+		h.update(repr(value))
+	h.update("\0")
+
+def hash_hooks(h, hooknames):
+	"""Add the identities of the plugin functions attached to the given
+	hooks to a hashlib object."""
+	for hookname in hooknames:
+		for func in attached.get(hookname, []):
+			hash_value(h, hookname)
+			code = getattr(func, "func_code", None)
+			if code is None:
+				# We can't tell if this has changed, so make sure
+				# the key won't match next time.
+				hash_value(h, repr(func))
+				continue
+			# Include the plugin file's details, so that editing
+			# it throws away the cached HTML.
+			try:
+				st = os.stat(code.co_filename)
+				stamp = (st.st_size, st.st_mtime)
+			except OSError:
+				stamp = None
+			hash_value(h, [code.co_filename, code.co_name, stamp])
+
+def get_render_fingerprint(config):
+	"""Return a string identifying the settings and plugins that affect
+	the HTML produced by sanitise_html, for use in render cache keys."""
+	h = hashlib.sha1()
+	hash_value(h, [VERSION, feedparser.__version__,
+	               config["tidyhtml"], config["blocklevelhtml"],
+	               tidylib is not None, mxtidy is not None])
+	hash_hooks(h, ["mxtidy_args", "tidy_args", "clean_html"])
+	return h.hexdigest()
+
 template_re = re.compile(r'(__[^_].*?__)')
+
+# Operations in a compiled template.
+TEMPLATE_TEXT = 0
+TEMPLATE_BIT = 1
+TEMPLATE_IF = 2
+TEMPLATE_ELSE = 3
+TEMPLATE_ENDIF = 4
+
+def compile_template(template):
+	"""Compile a template into a list of (operation, argument, jump)
+	tuples. Each __if_x__ and __else__ has the index of the operation to
+	jump to if the section that follows it isn't being expanded: just
+	after the next __else__ or __endif__ at the same level, or the end of
+	the template."""
+	program = []
+	# For each open __if_x__, the index of its last __if_x__ or __else__.
+	open_ifs = []
+	def close_section():
+		last = open_ifs[-1]
+		op, arg, jump = program[last]
+		program[last] = (op, arg, len(program) + 1)
+
+	for part in template_re.split(template):
+		if part.startswith("__") and part.endswith("__"):
+			key = part[2:-2]
+			if key.startswith("if_"):
+				open_ifs.append(len(program))
+				program.append((TEMPLATE_IF, key[3:], None))
+			elif key == "endif":
+				if open_ifs != []:
+					close_section()
+					open_ifs.pop()
+					program.append((TEMPLATE_ENDIF, None, None))
+			elif key == "else":
+				if open_ifs != []:
+					close_section()
+					open_ifs[-1] = len(program)
+					program.append((TEMPLATE_ELSE, None, None))
+			else:
+				program.append((TEMPLATE_BIT, key, None))
+		elif part != "":
+			program.append((TEMPLATE_TEXT, part, None))
+
+	# Sections that aren't closed extend to the end of the template.
+	while open_ifs != []:
+		last = open_ifs.pop()
+		op, arg, jump = program[last]
+		program[last] = (op, arg, len(program))
+	return program
+
+compiled_templates = {}
+def get_compiled_template(template):
+	"""Return the compiled version of a template, caching the result."""
+	program = compiled_templates.get(template)
+	if program is None:
+		if len(compiled_templates) > 100:
+			# Something's generating lots of templates.
+			compiled_templates.clear()
+		program = compile_template(template)
+		compiled_templates[template] = program
+	return program
+
 def fill_template(template, bits):
 	"""Expand a template, replacing __x__ with bits["x"], and only
 	including sections bracketed by __if_x__ .. [__else__ ..]
@@ -257,35 +395,58 @@ def fill_template(template, bits):
 	if result.value is not None:
 		return result.value
 
+	program = get_compiled_template(template)
+	return expand_template(program, bits, 0, len(program))
+
+def expand_template(program, bits, start, end):
+	"""Expand the operations from start to end of a compiled template.
+	The section must not contain only part of a conditional."""
 	encoding = get_system_encoding()
 
-	f = StringIO()
-	if_stack = []
-	def write(s):
-		if not False in if_stack:
-			f.write(s)
-	for part in template_re.split(template):
-		if part.startswith("__") and part.endswith("__"):
-			key = part[2:-2]
-			if key.startswith("if_"):
-				k = key[3:]
-				if_stack.append(bits.has_key(k) and bits[k] != "")
-			elif key == "endif":
-				if if_stack != []:
-					if_stack.pop()
-			elif key == "else":
-				if if_stack != []:
-					if_stack.append(not if_stack.pop())
-			elif bits.has_key(key):
-				if type(bits[key]) == types.UnicodeType:
-					write(bits[key].encode(encoding))
-				else:
-					write(bits[key])
-		else:
-			write(part)
-	v = f.getvalue()
-	f.close()
-	return v
+	out = [""] * (end - start)
+	n = 0
+	i = start
+	while i < end:
+		op, arg, jump = program[i]
+		i += 1
+		if op == TEMPLATE_TEXT:
+			out[n] = arg
+			n += 1
+		elif op == TEMPLATE_BIT:
+			if arg in bits:
+				value = bits[arg]
+				if type(value) == types.UnicodeType:
+					value = value.encode(encoding)
+				out[n] = value
+				n += 1
+		elif op == TEMPLATE_IF:
+			if not (arg in bits and bits[arg] != ""):
+				i = jump
+		elif op == TEMPLATE_ELSE:
+			# We've just expanded the section before this, so
+			# skip the one after it.
+			i = jump
+	return "".join(out)
+
+def find_template_bit(template, key):
+	"""If __key__ appears exactly once in a template, outside any
+	conditional section, and the template doesn't use __if_key__, then
+	return the index of the operation that expands it in the compiled
+	template. Otherwise, return None."""
+	found = None
+	depth = 0
+	for i, (op, arg, jump) in enumerate(get_compiled_template(template)):
+		if op == TEMPLATE_IF:
+			if arg == key:
+				return None
+			depth += 1
+		elif op == TEMPLATE_ENDIF:
+			depth -= 1
+		elif op == TEMPLATE_BIT and arg == key:
+			if found is not None or depth > 0:
+				return None
+			found = i
+	return found
 
 file_cache = {}
 def load_file(name):
@@ -349,6 +510,74 @@ def ensure_unicode(value, encoding):
 	else:
 		return value
 
+def normalise_fields(value, fields, encoding):
+	"""Return a copy of a dictionary from a feedparser result, containing
+	only the given fields (or all of them, if fields is None), with
+	their values converted by ensure_unicode."""
+	d = {}
+	for (k, v) in value.items():
+		if fields is None or k in fields:
+			d[k] = ensure_unicode(v, encoding)
+	return d
+
+# Fields of a feedparser result that rawdog adds itself, which don't
+# need converting.
+RAWDOG_RESULT_FIELDS = ["rawdog_exception", "rawdog_traceback", "rawdog_responses"]
+
+def normalise_result(p, entry_fields, feed_fields):
+	"""Convert a feedparser result into the form that Feed.update
+	expects: plain dictionaries and lists, containing only the given
+	entry and feed fields (or all of them, if the set is None), with
+	all strings as unicode objects. This is done in the thread or
+	process that parsed the feed, so what gets passed back to the main
+	thread is small and can be pickled."""
+	encoding = p.get("encoding") or "UTF-8"
+	result = {}
+	for (key, value) in p.items():
+		if key == "feed":
+			value = normalise_fields(value, feed_fields, encoding)
+		elif key == "entries":
+			value = [normalise_fields(entry, entry_fields, encoding)
+			         for entry in value]
+		elif key not in RAWDOG_RESULT_FIELDS:
+			value = ensure_unicode(value, encoding)
+		result[key] = value
+	return result
+
+max_age_re = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)', re.I)
+def get_cache_lifetime(headers):
+	"""Return the number of seconds that an HTTP response may be cached
+	for according to its Cache-Control or Expires headers, or None if it
+	doesn't say."""
+	headers = dict((k.lower(), v) for (k, v) in headers.items())
+
+	cache_control = headers.get("cache-control", "")
+	if "no-cache" in cache_control or "no-store" in cache_control:
+		return 0
+	m = max_age_re.search(cache_control)
+	if m is not None:
+		lifetime = int(m.group(1))
+		age = headers.get("age", "")
+		if age.isdigit():
+			lifetime -= int(age)
+		return max(lifetime, 0)
+
+	expires = headers.get("expires")
+	if expires is None:
+		return None
+	expires = email.utils.parsedate_tz(expires)
+	if expires is None:
+		# An invalid date means it's already expired.
+		return 0
+	# Measure from the server's idea of the current time if it gave
+	# one, in case its clock is wrong.
+	date = email.utils.parsedate_tz(headers.get("date", ""))
+	if date is not None:
+		now = email.utils.mktime_tz(date)
+	else:
+		now = time.time()
+	return max(email.utils.mktime_tz(expires) - now, 0)
+
 timeout_re = re.compile(r'timed? ?out', re.I)
 def is_timeout_exception(exc):
 	"""Return True if the given exception object suggests that a timeout
@@ -424,10 +653,90 @@ class ResponseLogProcessor(urllib2.BaseHandler):
 	def get_log(self):
 		return self.log
 
+class BodyUnchanged(Exception):
+	"""Raised by BodyDigestProcessor when a feed's body is the same as
+	last time it was fetched."""
+
+	def __init__(self, headers):
+		Exception.__init__(self, "The feed has not changed")
+		self.headers = headers
+
+class BodyDigestProcessor(urllib2.BaseHandler):
+	"""urllib2 handler that adds a digest of each successful response's
+	body to a ResponseLogProcessor's log. If the digest is the same as
+	last_digest, it raises BodyUnchanged, so that the feed doesn't get
+	parsed again."""
+
+	# Run after ResponseLogProcessor, but before HTTPErrorProcessor.
+	handler_order = 950
+
+	def __init__(self, logger, last_digest):
+		self.logger = logger
+		self.last_digest = last_digest
+
+	def http_response(self, req, response):
+		if response.getcode() != 200:
+			return response
+
+		data = response.read()
+		response.close()
+		digest = hashlib.sha1(data).hexdigest()
+		log = self.logger.get_log()
+		if len(log) > 0:
+			log[-1]["digest"] = digest
+		if digest == self.last_digest:
+			raise BodyUnchanged(dict(response.info()))
+
+		new_response = urllib.addinfourl(StringIO(data), response.info(),
+		                                 response.geturl(), response.getcode())
+		new_response.msg = response.msg
+		return new_response
+
+	https_response = http_response
+
+# How much weight to give the latest fetch when updating a feed's history
+# for adaptiveperiods.
+ADAPTIVE_WEIGHT = 0.3
+
+# The shortest time to wait before retrying a feed that's failed, if
+# maxbackoff is set.
+BACKOFF_MIN_DELAY = 5 * 60
+
 non_alphanumeric_re = re.compile(r'<[^>]*>|\&[^\;]*\;|[^a-z0-9]')
 class Feed:
 	"""An RSS feed."""
 
+	# The HTML describing the feed, cached by get_html_bits.
+	cached_html = None
+
+	# The history used to pick when to next update the feed (and, if
+	# adaptiveperiods is turned on, how often). These are class
+	# attributes so that feeds from old state files have them.
+	next_update = None
+	fetch_time = None
+	cache_lifetime = None
+	last_new_articles = None
+	change_interval = None
+	unchanged_rate = 0.0
+
+	# The feed's record of failed updates.
+	failures = 0
+	first_failure = None
+	last_error = None
+	backoff_until = None
+
+	# A digest of the feed's body when it was last fetched, and how
+	# many times fetching it has found it unchanged because the server
+	# said it wasn't modified, or because the body was the same.
+	body_digest = None
+	update_count = 0
+	not_modified_count = 0
+	same_body_count = 0
+
+	# The SeenFilter of articles that have been expired, if
+	# rememberexpired is set.
+	expired_filter = None
+
 	def __init__(self, url):
 		self.url = url
 		self.period = 30 * 60
@@ -437,21 +746,165 @@ class Feed:
 		self.last_update = 0
 		self.feed_info = {}
 
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop("cached_html", None)
+		return state
+
 	def needs_update(self, now):
 		"""Return True if it's time to update this feed, or False if
 		its update period has not yet elapsed."""
-		return (now - self.last_update) >= self.period
+		return now >= self.get_next_update()
+
+	def get_next_update(self):
+		"""Return the time when the feed should next be updated."""
+		if self.next_update is not None:
+			next_update = self.next_update
+		else:
+			next_update = self.last_update + self.period
+		if self.backoff_until is not None:
+			next_update = max(next_update, self.backoff_until)
+		return next_update
+
+	def update_failed(self, now, config, error):
+		"""Record that updating the feed failed. If maxbackoff is set,
+		put off the next update for exponentially longer after each
+		consecutive failure, with some randomness so that feeds that
+		failed together don't all get retried together."""
+		self.failures += 1
+		if self.first_failure is None:
+			self.first_failure = now
+		self.last_error = error
+
+		if config["maxbackoff"] > 0:
+			delay = max(self.period, BACKOFF_MIN_DELAY) * (2 ** min(self.failures - 1, 30))
+			delay = min(delay, config["maxbackoff"])
+			delay *= 0.5 + random.random() / 2
+			self.backoff_until = now + delay
+		else:
+			self.backoff_until = None
+
+	def update_succeeded(self):
+		"""Record that updating the feed succeeded."""
+		self.update_count += 1
+		self.failures = 0
+		self.first_failure = None
+		self.last_error = None
+		self.backoff_until = None
+
+	def get_priority(self, now):
+		"""Return how urgently the feed needs updating: the number of
+		seconds it's overdue by per second it usually takes to fetch."""
+		fetch_time = self.fetch_time
+		if fetch_time is None:
+			fetch_time = 1.0
+		return (now - self.get_next_update()) / max(fetch_time, 0.1)
+
+	def record_fetch_time(self, seconds):
+		"""Record how long it took to fetch the feed."""
+		if self.fetch_time is None:
+			self.fetch_time = seconds
+		else:
+			self.fetch_time += ADAPTIVE_WEIGHT * (seconds - self.fetch_time)
+
+	def get_spread_period(self):
+		"""Return the time to wait after the first update before updating
+		the feed again. This is up to half a period longer than usual,
+		depending on the URL, so that feeds that were added at the same
+		time don't all need updating at the same time from then on."""
+		spread = int(short_hash(self.url), 16) / float(1 << 32)
+		return self.period * (1.0 + spread / 2)
+
+	def schedule_update(self, now, config, headers, found_new):
+		"""Record the results of fetching the feed, and pick when it
+		should next be updated. If adaptiveperiods is turned on, this is
+		based on how often the feed has had new articles in the past,
+		how often fetching it finds nothing new, and how long the server
+		says its response can be cached for, but no sooner than
+		minperiod and no later than maxperiod."""
+		if not config["adaptiveperiods"]:
+			return
+
+		self.cache_lifetime = get_cache_lifetime(headers)
+		if found_new:
+			if self.last_new_articles is not None:
+				interval = now - self.last_new_articles
+				if self.change_interval is None:
+					self.change_interval = interval
+				else:
+					self.change_interval += ADAPTIVE_WEIGHT * (interval - self.change_interval)
+			self.last_new_articles = now
+			unchanged = 0.0
+		else:
+			unchanged = 1.0
+		self.unchanged_rate += ADAPTIVE_WEIGHT * (unchanged - self.unchanged_rate)
+
+		period = self.period
+		if self.change_interval is not None:
+			# Check about twice as often as it usually changes.
+			period = self.change_interval / 2
+			if self.last_new_articles is not None:
+				# ... unless it's gone quiet for longer than that.
+				period = max(period, (now - self.last_new_articles) / 2)
+		# Back off if fetching it usually finds nothing new.
+		period *= 1.0 + self.unchanged_rate
+		if self.cache_lifetime is not None:
+			period = max(period, self.cache_lifetime)
+		period = min(max(period, config["minperiod"]), config["maxperiod"])
+		self.next_update = now + period
+
+	def get_expired_keys(self, article, config):
+		"""Return the keys that an article is remembered by once it's
+		been expired: its hash, and (if useids is turned on) its ID."""
+		keys = [u"hash:" + article.hash]
+		guid = article.entry_info.get("id")
+		if config["useids"] and guid:
+			keys.append(u"id:" + guid)
+		return keys
+
+	def article_expired(self, article, config):
+		"""Remember that an article has been expired, so that it won't
+		be added again if it turns up in the feed later."""
+		size = config["rememberexpired"]
+		if size == 0:
+			self.expired_filter = None
+			return
+		# The filter's size is a number of keys, and each article can
+		# have two.
+		if config["useids"]:
+			size *= 2
+		if self.expired_filter is None or self.expired_filter.capacity != size:
+			self.expired_filter = SeenFilter(size)
+		for key in self.get_expired_keys(article, config):
+			self.expired_filter.add(key)
+
+	def was_expired(self, article, config):
+		"""Return True if an article from the feed has already been
+		expired."""
+		if config["rememberexpired"] == 0 or self.expired_filter is None:
+			return False
+		for key in self.get_expired_keys(article, config):
+			if key in self.expired_filter:
+				return True
+		return False
 
 	def get_state_filename(self):
 		return "feeds/%s.state" % (short_hash(self.url),)
 
 	def fetch(self, rawdog, config):
 		"""Fetch the current set of articles from the feed."""
+		(logger, handlers) = self.get_handlers(rawdog, config)
+		return self.parse(self.get_fetch_url(), logger, handlers)
+
+	def get_handlers(self, rawdog, config):
+		"""Return the urllib2 handlers to use when fetching the feed,
+		and the ResponseLogProcessor among them."""
 
 		handlers = []
 
 		logger = ResponseLogProcessor()
 		handlers.append(logger)
+		handlers.append(BodyDigestProcessor(logger, self.body_digest))
 
 		proxies = {}
 		for name, value in self.args.items():
@@ -475,15 +928,68 @@ class Feed:
 
 		call_hook("add_urllib2_handlers", rawdog, config, self, handlers)
 
+		# Use pooled connections, unless a plugin's provided its own
+		# handler.
+		if connection_pool is not None:
+			for klass, pooled_klass in ((urllib2.HTTPHandler, PooledHTTPHandler),
+			                            (urllib2.HTTPSHandler, PooledHTTPSHandler)):
+				for handler in handlers:
+					if isinstance(handler, klass):
+						break
+				else:
+					handlers.append(pooled_klass(connection_pool))
+
+		return (logger, handlers)
+
+	def fetch_raw(self, logger, handlers):
+		"""Fetch the feed using handlers without parsing it. Return the
+		response (a RawResponse, or a FailedResponse if it couldn't be
+		fetched) and the log of HTTP responses."""
+		try:
+			opener = urllib2.build_opener(*tuple(handlers + [feedparser._FeedURLHandler()]))
+			opener.addheaders = []
+			response = RawResponse(opener.open(self.make_request()))
+		except Exception, e:
+			response = FailedResponse(e)
+		return (response, logger.get_log())
+
+	def make_request(self):
+		"""Return a urllib2 Request for the feed, built in the same way
+		as feedparser would."""
+		url = self.get_fetch_url()
+
+		# This is what feedparser's _open_resource does.
+		if url.startswith("feed:http"):
+			url = url[5:]
+		elif url.startswith("feed:"):
+			url = "http:" + url[5:]
+		auth = None
+		(urltype, rest) = urllib.splittype(url)
+		(realhost, rest) = urllib.splithost(rest)
+		if realhost and urltype != "ftp":
+			(user_passwd, realhost) = urllib.splituser(realhost)
+			if user_passwd:
+				url = "%s://%s%s" % (urltype, realhost, rest)
+				auth = base64.b64encode(user_passwd)
+		return feedparser._build_urllib2_request(url, HTTP_AGENT,
+		                                         self.etag, self.modified,
+		                                         None, auth, {})
+
+	def get_fetch_url(self):
+		"""Return the URL to fetch the feed from."""
 		url = self.url
 		# Turn plain filenames into file: URLs. (feedparser will open
 		# plain filenames itself, but we want it to open the file with
 		# urllib2 so we get a URLError if something goes wrong.)
 		if not ":" in url:
 			url = "file:" + url
+		return url
 
+	def parse(self, source, logger, handlers):
+		"""Parse the feed from source, which may be a URL to fetch
+		using handlers, or a response that's already been fetched."""
 		try:
-			result = feedparser.parse(url,
+			result = feedparser.parse(source,
 				etag=self.etag,
 				modified=self.modified,
 				agent=HTTP_AGENT,
@@ -519,10 +1025,15 @@ class Feed:
 		if version is None:
 			version = ""
 
+		if self.last_update == 0:
+			self.next_update = now + self.get_spread_period()
+		else:
+			self.next_update = None
 		self.last_update = now
 
 		errors = []
 		fatal = False
+		timed_out = False
 		old_url = self.url
 
 		if "rawdog_exception" in p:
@@ -530,7 +1041,12 @@ class Feed:
 			errors.append(str(p["rawdog_exception"]))
 			if config["showtracebacks"]:
 				from traceback import format_tb
-				errors.append("".join(format_tb(p["rawdog_traceback"])))
+				tb = p["rawdog_traceback"]
+				if not isinstance(tb, basestring):
+					# It hasn't been formatted by a parser
+					# process.
+					tb = "".join(format_tb(tb))
+				errors.append(tb)
 			errors.append("")
 			fatal = True
 
@@ -579,15 +1095,25 @@ class Feed:
 				errors.append(str(bozo_exception))
 				errors.append("")
 				fatal = True
-			elif config["ignoretimeouts"]:
-				return False
 			else:
 				errors.append("Timeout while reading feed.")
 				errors.append("")
 				fatal = True
+				timed_out = True
 		elif last_status == 304:
 			# The feed hasn't changed. Return False to indicate
 			# that we shouldn't do expiry.
+			self.not_modified_count += 1
+			self.update_succeeded()
+			self.schedule_update(now, config, p.get("headers", {}), False)
+			return False
+		elif isinstance(bozo_exception, BodyUnchanged):
+			# The server didn't say the feed hadn't changed, but
+			# it's the same as last time, so handle it the same
+			# way as a 304.
+			self.same_body_count += 1
+			self.update_succeeded()
+			self.schedule_update(now, config, bozo_exception.headers, False)
 			return False
 		elif last_status in [403, 410]:
 			# The feed is disallowed or gone. The feed should be
@@ -612,6 +1138,16 @@ class Feed:
 			fatal = True
 
 		old_error = "\n".join(errors)
+		if fatal:
+			self.update_failed(now, config, old_error)
+		else:
+			self.update_succeeded()
+
+		if timed_out and (config["ignoretimeouts"]
+		                  or now - self.first_failure < config["timeoutgrace"]):
+			# Don't report the timeout (yet).
+			return False
+
 		call_hook("feed_fetched", rawdog, config, self, p, old_error, not fatal)
 
 		if len(errors) != 0:
@@ -624,30 +1160,31 @@ class Feed:
 				return False
 
 		# From here, we can assume that we've got a complete feedparser
-		# response.
+		# response, which has already been through normalise_result.
 
-		p = ensure_unicode(p, p.get("encoding") or "UTF-8")
+		# Remember what the body was, so we don't need to parse it
+		# again if it's the same next time.
+		self.body_digest = None
+		if len(responses) > 0:
+			self.body_digest = responses[-1].get("digest")
 
 		# No entries means the feed hasn't changed, but for some reason
 		# we didn't get a 304 response. Handle it the same way.
 		if len(p["entries"]) == 0:
+			self.schedule_update(now, config, p.get("headers", {}), False)
 			return False
 
 		self.etag = p.get("etag")
 		self.modified = p.get("modified")
 
 		self.feed_info = p["feed"]
+		self.cached_html = None
 		feed = self.url
 
-		article_ids = {}
-		if config["useids"]:
-			# Find IDs for existing articles.
-			for (hash, a) in articles.items():
-				id = a.entry_info.get("id")
-				if a.feed == feed and id is not None:
-					article_ids[id] = a
-
+		fields = get_article_fields(rawdog, config)
+		find_similar = "similar" in config["hideduplicates"]
 		seen_articles = set()
+		added_articles = set()
 		sequence = 0
 		for entry_info in p["entries"]:
 			article = Article(feed, entry_info, now, sequence)
@@ -657,46 +1194,100 @@ class Feed:
 				continue
 			seen_articles.add(article.hash)
 			sequence += 1
+			if find_similar:
+				article.compute_simhash()
+			if fields is not None:
+				article.prune_fields(fields)
 
+			existing_article = None
 			id = entry_info.get("id")
-			if id in article_ids:
-				existing_article = article_ids[id]
-			elif article.hash in articles:
+			if config["useids"] and id is not None:
+				# Only match articles that were there before
+				# this update.
+				hash = articles.get_hash_for_id(feed, id)
+				if hash is not None and hash not in added_articles:
+					existing_article = articles[hash]
+			if existing_article is None and article.hash in articles:
 				existing_article = articles[article.hash]
-			else:
-				existing_article = None
 
 			if existing_article is not None:
+				old_keys = get_duplicate_keys(existing_article)
 				existing_article.update_from(article, now)
+				# Store it again so that the change is recorded.
+				articles[existing_article.hash] = existing_article
+				rawdog.update_duplicates(existing_article, old_keys)
 				call_hook("article_updated", rawdog, config, existing_article, now)
+			elif self.was_expired(article, config):
+				# It's been seen and expired before, so don't
+				# add it again.
+				pass
 			else:
 				articles[article.hash] = article
+				rawdog.index_duplicates(article)
+				added_articles.add(article.hash)
 				call_hook("article_added", rawdog, config, article, now)
 
 		if config["currentonly"]:
-			for (hash, a) in articles.items():
-				if a.feed == feed and hash not in seen_articles:
-					del articles[hash]
+			for hash in articles.get_feed_hashes(feed) - seen_articles:
+				rawdog.unindex_duplicates(articles[hash])
+				del articles[hash]
 
+		self.schedule_update(now, config, p.get("headers", {}),
+		                     len(added_articles) > 0)
 		return True
 
-	def get_html_name(self, config):
+	def get_html_bits(self, config):
+		"""Get a dictionary of the sanitised HTML used to describe the
+		feed. This is cached until the feed is next updated, and in the
+		render cache if it's in use."""
+		if self.cached_html is not None:
+			return self.cached_html
+
+		key = None
+		html = None
+		if render_cache is not None:
+			h = hashlib.sha1()
+			hash_value(h, ["feed", render_fingerprint, self.url,
+			               self.feed_info.get("title_detail"),
+			               self.feed_info.get("link")])
+			key = h.hexdigest()
+			html = render_cache.get(key)
+		if html is None:
+			html = self.make_html_bits(config)
+			if key is not None:
+				render_cache.put(key, html)
+
+		self.cached_html = html
+		return html
+
+	def make_html_bits(self, config):
+		"""Generate the HTML used to describe the feed."""
+		html = {}
+		html["title"] = detail_to_html(self.feed_info.get("title_detail"), True, config)
+
 		if self.feed_info.has_key("title_detail"):
-			r = detail_to_html(self.feed_info["title_detail"], True, config)
+			r = html["title"]
 		elif self.feed_info.has_key("link"):
 			r = string_to_html(self.feed_info["link"], config)
 		else:
 			r = string_to_html(self.url, config)
 		if r is None:
 			r = ""
-		return r
+		html["name"] = r
 
-	def get_html_link(self, config):
-		s = self.get_html_name(config)
 		if self.feed_info.has_key("link"):
-			return '<a href="' + string_to_html(self.feed_info["link"], config) + '">' + s + '</a>'
+			html["link"] = '<a href="' + string_to_html(self.feed_info["link"], config) + '">' + r + '</a>'
 		else:
-			return s
+			html["link"] = r
+
+		html["url"] = string_to_html(self.url, config)
+		return html
+
+	def get_html_name(self, config):
+		return self.get_html_bits(config)["name"]
+
+	def get_html_link(self, config):
+		return self.get_html_bits(config)["link"]
 
 	def get_id(self, config):
 		if self.args.has_key("id"):
@@ -708,11 +1299,108 @@ class Feed:
 	def get_keepmin(self, config):
 		return self.args.get("keepmin", config["keepmin"])
 
-class Article:
+# The entry_info fields that rawdog itself uses, which are kept when
+# prunefields is turned on.
+ARTICLE_FIELDS = [
+	"author",
+	"author_detail",
+	"content",
+	"id",
+	"link",
+	"summary_detail",
+	"title",
+	"title_detail",
+	]
+
+# The fields of entries that are needed to work out articles' dates.
+ENTRY_DATE_FIELDS = [
+	"created_parsed",
+	"published_parsed",
+	"updated_parsed",
+	]
+
+# The fields of feed_info that rawdog uses.
+FEED_FIELDS = [
+	"link",
+	"title_detail",
+	]
+
+def get_article_fields(rawdog, config):
+	"""Return the set of entry_info fields that should be stored for each
+	article, or None if all of them should be."""
+	if not config["prunefields"]:
+		return None
+	fields = set(ARTICLE_FIELDS)
+	call_hook("article_fields", rawdog, config, fields)
+	return fields
+
+def get_entry_fields(rawdog, config):
+	"""Return the set of fields of feedparser's entries that should be
+	kept when a feed's been parsed, or None if all of them should be."""
+	fields = get_article_fields(rawdog, config)
+	if fields is not None:
+		fields.update(ENTRY_DATE_FIELDS)
+	return fields
+
+def get_feed_fields(rawdog, config):
+	"""Return the set of feed_info fields that should be stored for each
+	feed, or None if all of them should be."""
+	if not config["prunefields"]:
+		return None
+	fields = set(FEED_FIELDS)
+	call_hook("feed_fields", rawdog, config, fields)
+	return fields
+
+def get_ingest_digest(rawdog, config):
+	"""Return a digest of the settings that affect what's stored when a
+	feed is parsed."""
+	def sorted_fields(fields):
+		if fields is None:
+			return None
+		return sorted(fields)
+	h = hashlib.sha1()
+	hash_value(h, [config["useids"],
+	               "similar" in config["hideduplicates"],
+	               sorted_fields(get_article_fields(rawdog, config)),
+	               sorted_fields(get_feed_fields(rawdog, config))])
+	return h.hexdigest()
+
+interned_urls = {}
+def intern_url(url):
+	"""Return a shared copy of a feed URL, so that the articles from a feed
+	don't each need their own copy."""
+	return interned_urls.setdefault(url, url)
+
+def get_entry_digest(article):
+	"""Return a digest of the ARTICLE_FIELDS in an article's
+	entry_info."""
+	h = hashlib.sha1()
+	entry_info = article.entry_info
+	for key in ARTICLE_FIELDS:
+		hash_value(h, entry_info.get(key))
+	return h.hexdigest()
+
+class Article(object):
 	"""An article retrieved from an RSS feed."""
 
-	def __init__(self, feed, entry_info, now, sequence):
-		self.feed = feed
+	# rawdog keeps lots of these, so they don't have a __dict__.
+	__slots__ = (
+		"feed",
+		"entry_info",
+		"sequence",
+		"date",
+		"hash",
+		"last_seen",
+		"added",
+		"simhash",
+		)
+
+	def __init__(self, feed=None, entry_info=None, now=None, sequence=None):
+		if entry_info is None:
+			# Being unpickled from an old state file.
+			return
+
+		self.feed = intern_url(feed)
 		self.entry_info = entry_info
 		self.sequence = sequence
 
@@ -732,6 +1420,30 @@ class Article:
 
 		self.last_seen = now
 		self.added = now
+		self.simhash = None
+
+	def __getstate__(self):
+		return tuple([getattr(self, name) for name in self.__slots__])
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# rawdog before 2.22 saved the Article's __dict__.
+			state = [state.get(name) for name in self.__slots__]
+		# Slots that have been added since the state was saved are
+		# None.
+		state = list(state) + [None] * (len(self.__slots__) - len(state))
+		for name, value in zip(self.__slots__, state):
+			setattr(self, name, value)
+		self.feed = intern_url(self.feed)
+
+	def prune_fields(self, fields):
+		"""Discard the fields of entry_info that aren't in fields."""
+		entry_info = self.entry_info
+		pruned = entry_info.__class__()
+		for key in fields:
+			if entry_info.has_key(key):
+				pruned[key] = entry_info[key]
+		self.entry_info = pruned
 
 	def compute_initial_hash(self):
 		"""Compute an initial unique hash for an article.
@@ -757,22 +1469,73 @@ class Article:
 
 		return h.hexdigest()
 
+	def compute_simhash(self):
+		"""Compute the signature used to find articles that are nearly
+		the same as this one, from its title and summary."""
+		entry_info = self.entry_info
+		parts = [entry_info.get("title", u"")]
+		if entry_info.has_key("summary_detail"):
+			parts.append(entry_info["summary_detail"]["value"])
+		elif entry_info.has_key("content"):
+			parts.append(entry_info["content"][0]["value"])
+		self.simhash = rawdoglib.simhash.compute_simhash(u" ".join(parts))
+
 	def update_from(self, new_article, now):
 		"""Update this article's contents from a newer article that's
 		been identified to be the same."""
 		self.entry_info = new_article.entry_info
 		self.sequence = new_article.sequence
 		self.date = new_article.date
+		self.simhash = new_article.simhash
 		self.last_seen = now
 
 	def can_expire(self, now, config):
 		return (now - self.last_seen) > config["expireage"]
 
 	def get_sort_date(self, config):
-		if config["sortbyfeeddate"]:
-			return self.date or self.added
-		else:
-			return self.added
+		return get_sort_date(self.date, self.added, config)
+
+def get_sort_date(date, added, config):
+	"""Return the date that an article should be sorted by."""
+	if config["sortbyfeeddate"]:
+		return date or added
+	else:
+		return added
+
+def summarise_articles(articles):
+	"""Return a summary of a dict of articles, with enough information
+	about each article to decide whether to write it without loading
+	the article itself."""
+	summary = {}
+	for key, article in articles.items():
+		summary[key] = (article.date, article.added, article.sequence,
+		                article.last_seen)
+	return summary
+
+def get_duplicate_keys(article):
+	"""Return the keys that identify an article when looking for
+	duplicates of it: one for its ID and one for its link, if it has
+	them, and one for each band of its simhash, if it has one."""
+	keys = []
+	entry_info = article.entry_info
+	guid = entry_info.get("id")
+	if guid:
+		keys.append(u"id:" + guid)
+	link = entry_info.get("link")
+	if link:
+		keys.append(u"link:" + link)
+	if article.simhash is not None:
+		for band in rawdoglib.simhash.get_bands(article.simhash):
+			keys.append(u"sim:" + band)
+	return keys
+
+def uses_dup_index(config):
+	"""Return True if the duplicate index is needed to find the articles
+	that hideduplicates says should be hidden."""
+	for key in ("id", "link", "similar"):
+		if key in config["hideduplicates"]:
+			return True
+	return False
 
 class DayWriter:
 	"""Utility class for writing day sections into a series of articles."""
@@ -834,6 +1597,19 @@ def parse_time(value, default="m"):
 			return int(value[:-len(unit)]) * size
 	return int(value) * units[default]
 
+def parse_size(value):
+	"""Parse a size in bytes with optional units (k, M, G). Raises
+	ValueError if the format isn't recognised."""
+	units = {
+		"k": 1024,
+		"M": 1024 * 1024,
+		"G": 1024 * 1024 * 1024,
+		}
+	for unit, size in units.items():
+		if value.endswith(unit):
+			return int(value[:-len(unit)]) * size
+	return int(value)
+
 def parse_bool(value):
 	"""Parse a boolean value (0, 1, false or true). Raise ValueError if
 	the value isn't recognised."""
@@ -870,6 +1646,8 @@ def parse_feed_args(argparams, arglines):
 			args[name] = int(value)
 		elif name == "maxage":
 			args[name] = parse_time(value)
+		elif name == "maxarticles":
+			args[name] = int(value)
 	return args
 
 class ConfigError(Exception):
@@ -926,6 +1704,22 @@ class Config:
 			"changeconfig": False,
 			"numthreads": 1,
 			"splitstate": False,
+			"statebackend": "pickle",
+			"fetchengine": "threads",
+			"hostconnections": 4,
+			"parseprocesses": 0,
+			"parsetimeout": 60,
+			"adaptiveperiods": False,
+			"minperiod": 30 * 60,
+			"maxperiod": 24 * 60 * 60,
+			"updatebudget": 0,
+			"maxbackoff": 0,
+			"daemoninterval": 60,
+			"rememberexpired": 0,
+			"timeoutgrace": 0,
+			"journalsize": 4 * 1024 * 1024,
+			"prunefields": False,
+			"rendercachesize": 0,
 			"useids": False,
 			}
 
@@ -1013,12 +1807,16 @@ class Config:
 			self["outputfile"] = l[1]
 		elif l[0] == "maxarticles":
 			self["maxarticles"] = int(l[1])
+		elif l[0] == "rendercachesize":
+			self["rendercachesize"] = int(l[1])
 		elif l[0] == "maxage":
 			self["maxage"] = parse_time(l[1])
 		elif l[0] == "expireage":
 			self["expireage"] = parse_time(l[1])
 		elif l[0] == "keepmin":
 			self["keepmin"] = int(l[1])
+		elif l[0] == "rememberexpired":
+			self["rememberexpired"] = int(l[1])
 		elif l[0] == "dayformat":
 			self["dayformat"] = l[1]
 		elif l[0] == "timeformat":
@@ -1043,6 +1841,12 @@ class Config:
 			self["verbose"] = parse_bool(l[1])
 		elif l[0] == "ignoretimeouts":
 			self["ignoretimeouts"] = parse_bool(l[1])
+		elif l[0] == "timeoutgrace":
+			self["timeoutgrace"] = parse_time(l[1])
+		elif l[0] == "maxbackoff":
+			self["maxbackoff"] = parse_time(l[1])
+		elif l[0] == "daemoninterval":
+			self["daemoninterval"] = parse_time(l[1])
 		elif l[0] == "showtracebacks":
 			self["showtracebacks"] = parse_bool(l[1])
 		elif l[0] == "daysections":
@@ -1061,12 +1865,38 @@ class Config:
 			self["hideduplicates"] = parse_list(l[1])
 		elif l[0] == "newfeedperiod":
 			self["newfeedperiod"] = l[1]
+		elif l[0] == "adaptiveperiods":
+			self["adaptiveperiods"] = parse_bool(l[1])
+		elif l[0] == "minperiod":
+			self["minperiod"] = parse_time(l[1])
+		elif l[0] == "maxperiod":
+			self["maxperiod"] = parse_time(l[1])
+		elif l[0] == "updatebudget":
+			self["updatebudget"] = parse_time(l[1])
 		elif l[0] == "changeconfig":
 			self["changeconfig"] = parse_bool(l[1])
 		elif l[0] == "numthreads":
 			self["numthreads"] = int(l[1])
 		elif l[0] == "splitstate":
 			self["splitstate"] = parse_bool(l[1])
+		elif l[0] == "statebackend":
+			if l[1] not in ("pickle", "sqlite", "journal"):
+				raise ValueError("Bad state backend: " + l[1])
+			self["statebackend"] = l[1]
+		elif l[0] == "fetchengine":
+			if l[1] not in ("threads", "async"):
+				raise ValueError("Bad fetch engine: " + l[1])
+			self["fetchengine"] = l[1]
+		elif l[0] == "hostconnections":
+			self["hostconnections"] = int(l[1])
+		elif l[0] == "parseprocesses":
+			self["parseprocesses"] = int(l[1])
+		elif l[0] == "parsetimeout":
+			self["parsetimeout"] = parse_time(l[1], "s")
+		elif l[0] == "journalsize":
+			self["journalsize"] = parse_size(l[1])
+		elif l[0] == "prunefields":
+			self["prunefields"] = parse_bool(l[1])
 		elif l[0] == "useids":
 			self["useids"] = parse_bool(l[1])
 		elif l[0] == "include":
@@ -1179,15 +2009,57 @@ def remove_feed(filename, url, config):
 		print >>sys.stderr, "Removing feed " + url
 		edit_file(filename, RemoveFeedEditor(url).edit)
 
+def parse_raw_response(task):
+	"""Parse a RawResponse, and normalise the result using the given
+	entry and feed fields. This is called in a parser process, so the
+	result must be picklable."""
+	(response, entry_fields, feed_fields) = task
+	try:
+		p = feedparser.parse(response.open(), agent=HTTP_AGENT)
+	except Exception, e:
+		from traceback import format_tb
+		return {
+			"rawdog_exception": Exception(str(e)),
+			"rawdog_traceback": "".join(format_tb(sys.exc_info()[2])),
+			}
+	bozo_exception = p.get("bozo_exception")
+	if bozo_exception is not None:
+		try:
+			pickle.dumps(bozo_exception, pickle.HIGHEST_PROTOCOL)
+		except Exception:
+			p["bozo_exception"] = Exception(str(bozo_exception))
+	return normalise_result(p, entry_fields, feed_fields)
+
+def get_parse_result(config, result):
+	"""Convert the result of parsing a feed in a parser process into a
+	feedparser result."""
+	(status, value) = result
+	if status == "ok":
+		return value
+	if status == "died" and value == -signal.SIGXCPU:
+		message = "Parsing the feed took more than %d seconds of CPU time" % config["parsetimeout"]
+	elif status == "died":
+		message = "The parser process died (exit status %s)" % value
+	else:
+		message = value
+	return {
+		"rawdog_exception": Exception(message),
+		"rawdog_traceback": "",
+		}
+
 class FeedFetcher:
 	"""Class that will handle fetching a set of feeds in parallel."""
 
-	def __init__(self, rawdog, feedlist, config):
+	def __init__(self, rawdog, feedlist, config, output, raw=False):
 		self.rawdog = rawdog
 		self.config = config
+		self.output = output
+		self.raw = raw
 		self.lock = threading.Lock()
-		self.jobs = set(feedlist)
-		self.results = {}
+		# Feeds are fetched in the order given.
+		self.jobs = list(reversed(feedlist))
+		self.deadline = None
+		self.start_times = {}
 
 	def worker(self, num):
 		rawdog = self.rawdog
@@ -1195,19 +2067,25 @@ class FeedFetcher:
 
 		while True:
 			with self.lock:
-				try:
-					job = self.jobs.pop()
-				except KeyError:
+				if self.deadline is not None and time.time() >= self.deadline:
+					# Out of time; don't start any more.
+					del self.jobs[:]
+				if self.jobs == []:
 					# No jobs left.
 					break
+				job = self.jobs.pop()
 
 			config.log("[", num, "] Fetching feed: ", job)
+			self.start_times[job] = time.time()
 			feed = rawdog.feeds[job]
 			call_hook("pre_update_feed", rawdog, config, feed)
-			result = feed.fetch(rawdog, config)
+			if self.raw:
+				(logger, handlers) = feed.get_handlers(rawdog, config)
+				result = feed.fetch_raw(logger, handlers)
+			else:
+				result = feed.fetch(rawdog, config)
 
-			with self.lock:
-				self.results[job] = result
+			self.output(job, result)
 
 	def run(self, max_workers):
 		max_workers = max(max_workers, 1)
@@ -1218,31 +2096,545 @@ class FeedFetcher:
 		workers = []
 		for i in range(1, num_workers):
 			t = threading.Thread(target=self.worker, args=(i,))
+			t.daemon = True
 			t.start()
 			workers.append(t)
 		self.worker(0)
 		for worker in workers:
 			worker.join()
 		self.config.log("Fetch complete")
-		return self.results
 
-class FeedState(Persistable):
-	"""The collection of articles in a feed."""
+	def stop(self):
+		"""Don't start fetching any more feeds."""
+		with self.lock:
+			del self.jobs[:]
+
+class FetchPipeline:
+	"""Class that fetches and parses a set of feeds in background
+	threads, and passes the results back to the main thread through a
+	bounded queue as each feed is finished, so that the main thread can
+	merge them into the state while other feeds are still being
+	fetched."""
+
+	def __init__(self, rawdog, feedlist, config, deadline=None):
+		self.config = config
+		self.entry_fields = get_entry_fields(rawdog, config)
+		self.feed_fields = get_feed_fields(rawdog, config)
+		self.results = Queue.Queue(max(config["numthreads"], 1))
+		self.error = None
+		self.thread = None
+		self.finished = False
+		self.fetch_times = {}
+
+		# If we're using parser processes, then fetch the feeds
+		# without parsing them, and hand them to the parsers.
+		self.raw = config["parseprocesses"] > 0
+		self.parsers = None
+
+		if config["fetchengine"] == "async":
+			self.fetcher = AsyncFeedFetcher(rawdog, feedlist, config,
+			                                self.fetched, self.raw)
+		else:
+			self.fetcher = FeedFetcher(rawdog, feedlist, config,
+			                           self.fetched, self.raw)
+		self.fetcher.deadline = deadline
+
+	def fetched(self, url, result):
+		"""Called by the fetcher when a feed has been fetched."""
+		start_time = self.fetcher.start_times.get(url)
+		if start_time is not None:
+			self.fetch_times[url] = time.time() - start_time
+
+		if not self.raw:
+			self.results.put((url, self.normalise(result)))
+			return
+
+		(response, log) = result
+		if isinstance(response, FailedResponse):
+			# There's nothing to parse, so let feedparser report
+			# the error.
+			p = feedparser.parse(response, agent=HTTP_AGENT)
+			p["rawdog_responses"] = log
+			self.results.put((url, self.normalise(p)))
+		else:
+			self.parsers.put((url, log), (response, self.entry_fields,
+			                              self.feed_fields))
+
+	def normalise(self, p):
+		return normalise_result(p, self.entry_fields, self.feed_fields)
+
+	def parsed(self, key, result):
+		"""Called by the parser pool when a feed has been parsed."""
+		(url, log) = key
+		p = get_parse_result(self.config, result)
+		p["rawdog_responses"] = log
+		self.results.put((url, p))
+
+	def run(self):
+		global connection_pool
+		config = self.config
+		try:
+			if self.raw:
+				config.log("Parsing feeds using ",
+				           config["parseprocesses"], " processes")
+				self.parsers = ParserPool(config["parseprocesses"],
+				                          parse_raw_response,
+				                          config["parsetimeout"],
+				                          self.parsed)
+			if config["fetchengine"] != "async":
+				connection_pool = ConnectionPool(config["hostconnections"])
+			try:
+				self.fetcher.run(config["numthreads"])
+			finally:
+				if connection_pool is not None:
+					connection_pool.close()
+					connection_pool = None
+				if self.parsers is not None:
+					self.parsers.close()
+					config.log("Parse complete")
+		except:
+			self.error = sys.exc_info()
+		self.results.put(None)
+
+	def get_result(self):
+		"""Wait for the next result to arrive, and return it, or None if
+		there are no more."""
+		while True:
+			try:
+				# Waiting with a timeout means that the
+				# main thread can still be interrupted.
+				item = self.results.get(True, 3600)
+			except Queue.Empty:
+				continue
+			if item is None:
+				self.finished = True
+			return item
+
+	def get_results(self):
+		"""Start fetching the feeds, and yield (url, result) for each
+		feed as it's finished, in the order they finish."""
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		while True:
+			item = self.get_result()
+			if item is None:
+				break
+			yield item
+		self.thread.join()
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def stop(self):
+		"""If the results haven't all been collected, don't start
+		fetching any more feeds, and wait for the ones that have already
+		been started to finish."""
+		if self.thread is None or self.finished:
+			return
+		self.fetcher.stop()
+		while self.get_result() is not None:
+			pass
+		self.thread.join()
+
+class ArticleDict(dict):
+	"""A dictionary mapping article hashes to Articles, which keeps track
+	of the articles that have been stored or deleted since its changes
+	were last cleared, and indexes the articles by feed and by ID.
+
+	For each feed, it also keeps a heap of (last_seen, hash) pairs, so
+	the articles that are old enough to expire can be found without
+	looking at all of them. Entries in the heap aren't removed when an
+	article is changed or deleted; they're ignored when they come to the
+	top instead, and the heap is rebuilt if too many build up.
+
+	Only storing and deleting items is tracked; an Article that's been
+	changed in place must be stored again for this to notice."""
+
+	def __init__(self, articles={}):
+		dict.__init__(self)
+		self.changes = {}
+		self.by_feed = {}
+		self.by_id = {}
+		self.index_keys = {}
+		self.expiry_heaps = {}
+		for key, article in articles.items():
+			dict.__setitem__(self, key, article)
+			self._index(key, article)
+
+	def __reduce__(self):
+		# Don't save the changes or indexes.
+		return (ArticleDict, (dict(self),))
+
+	def __setitem__(self, key, article):
+		if key in self:
+			self._unindex(key)
+		dict.__setitem__(self, key, article)
+		self._index(key, article)
+		self.changes[key] = article
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self._unindex(key)
+		self.changes[key] = None
+
+	def _index(self, key, article):
+		feed = article.feed
+		id = article.entry_info.get("id")
+		hashes = self.by_feed.setdefault(feed, set())
+		hashes.add(key)
+		if id is not None:
+			self.by_id[(feed, id)] = key
+		self.index_keys[key] = (feed, id)
+
+		heap = self.expiry_heaps.setdefault(feed, [])
+		if len(heap) > 2 * len(hashes) + 16:
+			# Drop the entries for articles that have changed.
+			heap[:] = [(self[k].last_seen, k) for k in hashes]
+			heapq.heapify(heap)
+		else:
+			heapq.heappush(heap, (article.last_seen, key))
+
+	def _unindex(self, key):
+		feed, id = self.index_keys.pop(key)
+		hashes = self.by_feed[feed]
+		hashes.discard(key)
+		if not hashes:
+			del self.by_feed[feed]
+			del self.expiry_heaps[feed]
+		if id is not None and self.by_id.get((feed, id)) == key:
+			del self.by_id[(feed, id)]
+
+	def get_feed_hashes(self, url):
+		"""Return a set of the hashes of the articles from a feed."""
+		return set(self.by_feed.get(url, ()))
+
+	def get_hash_for_id(self, url, id):
+		"""Return the hash of an article from a feed with a given ID, or
+		None if there isn't one."""
+		return self.by_id.get((url, id))
+
+	def get_feeds(self):
+		"""Return a list of the feeds that have articles."""
+		return self.by_feed.keys()
+
+	def get_feed_count(self, url):
+		"""Return the number of articles from a feed."""
+		return len(self.by_feed.get(url, ()))
+
+	def get_expiry_candidates(self, url, cutoff):
+		"""Return the hashes of the articles from a feed that were last
+		seen before cutoff, oldest-added first."""
+		heap = self.expiry_heaps.get(url)
+		if heap is None:
+			return []
+
+		found = {}
+		while heap and heap[0][0] < cutoff:
+			last_seen, key = heapq.heappop(heap)
+			article = self.get(key)
+			if (article is not None and article.feed == url
+			    and article.last_seen == last_seen):
+				found[key] = article
+
+		# They're still in the dictionary until they're deleted, so
+		# put them back.
+		for key, article in found.items():
+			heapq.heappush(heap, (article.last_seen, key))
+
+		candidates = [(article.added, article.sequence, key)
+		              for key, article in found.items()]
+		candidates.sort()
+		return [key for (added, seq, key) in candidates]
+
+class ArticleStore(Persistable):
+	"""A persistent collection of articles. Changes to the articles can
+	be saved as journal records, rather than saving the whole
+	collection."""
 
 	def __init__(self):
 		Persistable.__init__(self)
-		self.articles = {}
+		self.articles = ArticleDict()
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if not isinstance(self.articles, ArticleDict):
+			# State files from rawdog before 2.22 used a plain
+			# dictionary.
+			self.articles = ArticleDict(self.articles)
+
+	def modified(self, state=True):
+		Persistable.modified(self, state)
+		if not state:
+			self.articles.changes = {}
+
+	def is_modified(self):
+		return self._modified or self.articles.changes != {}
+
+	def get_changes(self):
+		if self._modified:
+			return None
+		return [("articles", dict(self.articles.changes))]
+
+	def apply_change(self, change):
+		if change[0] == "articles":
+			for key, article in change[1].items():
+				if article is None:
+					if key in self.articles:
+						del self.articles[key]
+				else:
+					self.articles[key] = article
+		else:
+			Persistable.apply_change(self, change)
 
-class Rawdog(Persistable):
+class FeedState(ArticleStore):
+	"""The collection of articles in a feed."""
+
+	pass
+
+class Rawdog(ArticleStore):
 	"""The aggregator itself."""
 
 	def __init__(self):
-		Persistable.__init__(self)
+		ArticleStore.__init__(self)
 		self.feeds = {}
-		self.articles = {}
 		self.plugin_storage = {}
 		self.state_version = STATE_VERSION
 		self.using_splitstate = None
+		self.article_index = {}
+		self.dup_index = {}
+		self._changed_feeds = set()
+		self._changed_dups = set()
+
+	def modified(self, state=True):
+		ArticleStore.modified(self, state)
+		if not state:
+			self._changed_feeds = set()
+			self._changed_dups = set()
+
+	def feed_updated(self, feed):
+		"""Note that a feed's state has changed, so that the change
+		can be saved as a journal record."""
+		self._changed_feeds.add(feed.url)
+
+	def is_modified(self):
+		return (ArticleStore.is_modified(self)
+		        or self._changed_feeds != set()
+		        or self._changed_dups != set())
+
+	def get_changes(self):
+		changes = ArticleStore.get_changes(self)
+		if changes is not None:
+			index = self.get_article_index()
+			for url in self._changed_feeds:
+				changes.append(("feed", url, self.feeds[url]))
+				if url in index:
+					changes.append(("summary", url, index[url]))
+			for key in self._changed_dups:
+				changes.append(("dups", key, self.dup_index.get(key)))
+		return changes
+
+	def apply_change(self, change):
+		if change[0] == "feed":
+			self.feeds[change[1]] = change[2]
+		elif change[0] == "summary":
+			self.get_article_index()[change[1]] = change[2]
+		elif change[0] == "dups":
+			if change[2] is None:
+				self.dup_index.pop(change[1], None)
+			else:
+				self.dup_index[change[1]] = change[2]
+		else:
+			ArticleStore.apply_change(self, change)
+
+	def get_article_index(self):
+		"""Return the index of articles in split state files, which
+		maps each feed's URL to a summary of its articles."""
+		try:
+			return self.article_index
+		except AttributeError:
+			# rawdog before 2.22 didn't have the index.
+			self.article_index = {}
+			return self.article_index
+
+	def set_feed_summary(self, feed, articles):
+		"""Update the index entry for a feed in a split state file from
+		its articles."""
+		self.get_article_index()[feed.url] = summarise_articles(articles)
+		self.feed_updated(feed)
+
+	def get_dup_index(self):
+		"""Return the index used to find duplicate articles. This maps
+		each of get_duplicate_keys's keys to a list of (feed URL,
+		article hash) for the articles that have that key, in the order
+		they were first seen -- except that when a feed has a new
+		article with the same ID or link as one of its old ones, the new
+		one takes the old one's place. For simhash keys, the entries are
+		(feed URL, article hash, simhash).
+
+		The index is only kept up to date while it exists; it's built
+		when it's first needed."""
+		if self.has_dup_index():
+			return self.dup_index
+
+		# rawdog before 2.22 didn't have the index (and it's not kept
+		# when hideduplicates doesn't need it), so build it from all
+		# the articles.
+		self.dup_index = {}
+		self.dup_index_built = True
+		articles = self.articles.values()
+		if self.using_splitstate:
+			for feed in self.feeds.values():
+				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+					articles += feedstate.articles.values()
+		articles.sort(key=lambda article: (article.added, article.sequence))
+		for article in articles:
+			self.index_duplicates(article)
+		self.modified()
+		return self.dup_index
+
+	def has_dup_index(self):
+		"""Return True if the duplicate index has been built."""
+		return getattr(self, "dup_index_built", False)
+
+	def index_duplicates(self, article, keys=None):
+		"""Add an article to the duplicate index, under the given keys
+		(by default, all of its keys)."""
+		if not self.has_dup_index():
+			return
+		index = self.dup_index
+		if keys is None:
+			keys = get_duplicate_keys(article)
+		for key in keys:
+			entries = index.setdefault(key, [])
+			if key.startswith("sim:"):
+				entries.append((article.feed, article.hash, article.simhash))
+			else:
+				pos = len(entries)
+				for i, entry in enumerate(entries):
+					if entry[0] == article.feed:
+						pos = i
+						break
+				entries.insert(pos, (article.feed, article.hash))
+			self._changed_dups.add(key)
+
+	def unindex_duplicates(self, article, keys=None):
+		"""Remove an article from the duplicate index, under the given
+		keys (by default, all of its keys)."""
+		if not self.has_dup_index():
+			return
+		index = self.dup_index
+		if keys is None:
+			keys = get_duplicate_keys(article)
+		for key in keys:
+			entries = index.get(key)
+			if entries is None:
+				continue
+			new_entries = [entry for entry in entries
+			               if entry[:2] != (article.feed, article.hash)]
+			if len(new_entries) == len(entries):
+				continue
+			if new_entries == []:
+				del index[key]
+			else:
+				index[key] = new_entries
+			self._changed_dups.add(key)
+
+	def update_duplicates(self, article, old_keys):
+		"""Update the duplicate index after an article's contents have
+		changed, given the keys it had before."""
+		new_keys = get_duplicate_keys(article)
+		self.unindex_duplicates(article, [key for key in old_keys if key not in new_keys])
+		self.index_duplicates(article, [key for key in new_keys if key not in old_keys])
+
+	def change_feed_duplicates(self, oldurl, newurl):
+		"""Change or remove (if newurl is None) the duplicate index
+		entries for the articles in a feed."""
+		if not self.has_dup_index():
+			return
+		index = self.dup_index
+		for key, entries in index.items():
+			new_entries = []
+			for entry in entries:
+				if entry[0] != oldurl:
+					new_entries.append(entry)
+				elif newurl is not None:
+					new_entries.append((newurl,) + entry[1:])
+			if new_entries == entries:
+				continue
+			if new_entries == []:
+				del index[key]
+			else:
+				index[key] = new_entries
+			self._changed_dups.add(key)
+
+	def build_similar_index(self):
+		"""Compute the simhash of every article that doesn't have one,
+		and rebuild the simhash entries in the duplicate index. This is
+		needed when "hideduplicates similar" is turned on, since
+		simhashes are only computed for new articles while it's on."""
+		index = self.get_dup_index()
+		for key in index.keys():
+			if key.startswith("sim:"):
+				del index[key]
+				self._changed_dups.add(key)
+
+		def add_simhashes(articles, all_articles):
+			for key, article in articles.items():
+				if article.simhash is None:
+					article.compute_simhash()
+					# Store it again so that the change is
+					# recorded.
+					articles[key] = article
+				all_articles.append(article)
+
+		all_articles = []
+		add_simhashes(self.articles, all_articles)
+		if self.using_splitstate:
+			for feed in self.feeds.values():
+				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+					add_simhashes(feedstate.articles, all_articles)
+		all_articles.sort(key=lambda article: (article.added, article.sequence))
+		for article in all_articles:
+			if article.simhash is not None:
+				self.index_duplicates(article, [u"sim:" + band for band in rawdoglib.simhash.get_bands(article.simhash)])
+
+	def get_first_seen(self, key, candidates):
+		"""Return the hash of the first article seen with a duplicate
+		key, ignoring feeds that allow duplicates and articles whose
+		hashes aren't in the set candidates, or None if there isn't
+		one."""
+		for entry in self.get_dup_index().get(key, ()):
+			if entry[1] not in candidates:
+				continue
+			feed = self.feeds.get(entry[0])
+			if feed is not None and not feed.args.get("allowduplicates", False):
+				return entry[1]
+		return None
+
+	def get_similar(self, article, candidates):
+		"""Return the hash of an article from another feed that's nearly
+		the same as the given article (according to their simhashes)
+		and was seen before it, ignoring feeds that allow duplicates and
+		articles whose hashes aren't in the set candidates, or None if
+		there isn't one."""
+		if article.simhash is None:
+			return None
+		index = self.get_dup_index()
+		for band in rawdoglib.simhash.get_bands(article.simhash):
+			for (url, hash, simhash) in index.get(u"sim:" + band, ()):
+				if url == article.feed:
+					if hash == article.hash:
+						# Anything after this was seen later.
+						break
+					continue
+				if hash not in candidates:
+					continue
+				feed = self.feeds.get(url)
+				if (feed is not None
+				    and not feed.args.get("allowduplicates", False)
+				    and rawdoglib.simhash.get_distance(simhash, article.simhash) <= rawdoglib.simhash.MAX_DISTANCE):
+					return hash
+		return None
 
 	def get_plugin_storage(self, plugin):
 		try:
@@ -1280,18 +2672,25 @@ class Rawdog(Persistable):
 		feed.url = newurl
 		del self.feeds[oldurl]
 		self.feeds[newurl] = feed
+		index = self.get_article_index()
+		if oldurl in index:
+			index[newurl] = index.pop(oldurl)
+		self.change_feed_duplicates(oldurl, newurl)
 
 		if config["splitstate"]:
 			feedstate_p = persister.get(FeedState, old_state)
 			feedstate_p.rename(feed.get_state_filename())
 			with feedstate_p as feedstate:
-				for article in feedstate.articles.values():
+				for key, article in feedstate.articles.items():
 					article.feed = newurl
+					feedstate.articles[key] = article
 				feedstate.modified()
 		else:
-			for article in self.articles.values():
-				if article.feed == oldurl:
-					article.feed = newurl
+			for key in self.articles.get_feed_hashes(oldurl):
+				article = self.articles[key]
+				article.feed = newurl
+				self.articles[key] = article
+		self.modified()
 
 		print >>sys.stderr, "Feed URL automatically changed."
 
@@ -1304,13 +2703,21 @@ class Rawdog(Persistable):
 			print "  Hash:", short_hash(url)
 			print "  Title:", feed.get_html_name(config)
 			print "  Link:", feed_info.get("link")
+			print "  Updates:", feed.update_count
+			print "  Not modified:", feed.not_modified_count
+			print "  Same content:", feed.same_body_count
 
 	def sync_from_config(self, config):
 		"""Update rawdog's internal state to match the
 		configuration."""
 
+		# The database backend always stores each feed's articles
+		# separately.
+		if config["statebackend"] == "sqlite":
+			config["splitstate"] = True
+
 		# Make sure the splitstate directory exists.
-		if config["splitstate"]:
+		elif config["splitstate"]:
 			try:
 				os.mkdir("feeds")
 			except OSError:
@@ -1332,22 +2739,23 @@ class Rawdog(Persistable):
 				config.log("Converting to split state files")
 				for feed_hash, feed in self.feeds.items():
 					with persister.get(FeedState, feed.get_state_filename()) as feedstate:
-						feedstate.articles = {}
-						for article_hash, article in self.articles.items():
-							if article.feed == feed_hash:
-								feedstate.articles[article_hash] = article
+						feedstate.articles = ArticleDict()
+						for article_hash in self.articles.get_feed_hashes(feed_hash):
+							feedstate.articles[article_hash] = self.articles[article_hash]
 						feedstate.modified()
-				self.articles = {}
+						self.set_feed_summary(feed, feedstate.articles)
+				self.articles = ArticleDict()
 			else:
 				config.log("Converting to single state file")
-				self.articles = {}
+				self.articles = ArticleDict()
 				for feed_hash, feed in self.feeds.items():
 					with persister.get(FeedState, feed.get_state_filename()) as feedstate:
 						for article_hash, article in feedstate.articles.items():
 							self.articles[article_hash] = article
-						feedstate.articles = {}
+						feedstate.articles = ArticleDict()
 						feedstate.modified()
 					persister.delete(feed.get_state_filename())
+				self.article_index = {}
 			self.modified()
 			self.using_splitstate = config["splitstate"]
 
@@ -1359,44 +2767,94 @@ class Rawdog(Persistable):
 				self.feeds[url] = Feed(url)
 				self.modified()
 			feed = self.feeds[url]
+			# The config may have changed how the feed's HTML
+			# is generated.
+			feed.cached_html = None
 			if feed.period != period:
 				config.log("Changed feed period: ", url)
 				feed.period = period
 				self.modified()
+			if (feed.next_update is not None
+			    and not config["adaptiveperiods"]
+			    and feed.next_update > feed.last_update + feed.get_spread_period()):
+				# It was picked by adaptiveperiods.
+				feed.next_update = None
+				self.modified()
 			newargs = {}
 			newargs.update(config["feeddefaults"])
 			newargs.update(args)
 			if feed.args != newargs:
 				config.log("Changed feed options: ", url)
 				feed.args = newargs
+				# Make sure the feed gets parsed again with
+				# the new options.
+				feed.body_digest = None
 				self.modified()
 		for url in self.feeds.keys():
 			if url not in seen_feeds:
 				config.log("Removing feed: ", url)
+				self.change_feed_duplicates(url, None)
 				if config["splitstate"]:
 					persister.delete(self.feeds[url].get_state_filename())
+					self.get_article_index().pop(url, None)
 				else:
-					for key, article in self.articles.items():
-						if article.feed == url:
-							del self.articles[key]
+					for key in self.articles.get_feed_hashes(url):
+						del self.articles[key]
 				del self.feeds[url]
 				self.modified()
 
+		# Feeds whose bodies haven't changed aren't parsed again, so if
+		# the settings that affect parsing have changed, forget all
+		# the feeds' body digests.
+		digest = get_ingest_digest(self, config)
+		if digest != getattr(self, "ingest_digest", None):
+			for feed in self.feeds.values():
+				feed.body_digest = None
+			self.ingest_digest = digest
+			self.modified()
+
+		# The duplicate index takes up space in the state, so only keep
+		# it while it's needed.
+		if self.has_dup_index() and not uses_dup_index(config):
+			config.log("Removing index of duplicate articles")
+			self.dup_index = {}
+			self.dup_index_built = False
+			self.modified()
+
+		find_similar = "similar" in config["hideduplicates"]
+		if find_similar != getattr(self, "similar_indexed", False):
+			if find_similar:
+				config.log("Building index of similar articles")
+				self.build_similar_index()
+			self.similar_indexed = find_similar
+			self.modified()
+
 	def update(self, config, feedurl=None):
 		"""Perform the update action: check feeds for new articles, and
-		expire old ones."""
+		expire old ones. Return True if any articles might have
+		changed."""
 		config.log("Starting update")
 		now = time.time()
 
+		# Make sure the duplicate index exists before any articles
+		# are changed, if it's needed.
+		if uses_dup_index(config):
+			self.get_dup_index()
+
 		socket.setdefaulttimeout(config["timeout"])
 
 		if feedurl is None:
+			# Update the most urgent feeds first, in case we run
+			# out of time.
 			update_feeds = [url for url in self.feeds.keys()
 			                    if self.feeds[url].needs_update(now)]
+			update_feeds.sort(key=lambda url: self.feeds[url].get_priority(now),
+			                  reverse=True)
 		elif self.feeds.has_key(feedurl):
 			update_feeds = [feedurl]
 			self.feeds[feedurl].etag = None
 			self.feeds[feedurl].modified = None
+			self.feeds[feedurl].body_digest = None
 		else:
 			print "No such feed: " + feedurl
 			update_feeds = []
@@ -1404,82 +2862,101 @@ class Rawdog(Persistable):
 		numfeeds = len(update_feeds)
 		config.log("Will update ", numfeeds, " feeds")
 
-		fetcher = FeedFetcher(self, update_feeds, config)
-		fetched = fetcher.run(config["numthreads"])
-
 		seen_some_items = set()
 		def do_expiry(articles):
 			"""Expire articles from a list. Return True if any
 			articles were expired."""
 
-			feedcounts = {}
-			for key, article in articles.items():
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
-
-			expiry_list = []
-			feedcounts = {}
-			for key, article in articles.items():
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
-				expiry_list.append((article.added, article.sequence, key, article))
-			expiry_list.sort()
-
+			cutoff = now - config["expireage"]
 			count = 0
-			for date, seq, key, article in expiry_list:
-				url = article.feed
+			for url in articles.get_feeds():
 				if url not in self.feeds:
-					config.log("Expired article for nonexistent feed: ", url)
-					count += 1
-					del articles[key]
+					for key in articles.get_feed_hashes(url):
+						config.log("Expired article for nonexistent feed: ", url)
+						count += 1
+						self.unindex_duplicates(articles[key])
+						del articles[key]
 					continue
-				if (url in seen_some_items
-				    and self.feeds.has_key(url)
-				    and article.can_expire(now, config)
-				    and feedcounts[url] > self.feeds[url].get_keepmin(config)):
+				if url not in seen_some_items:
+					continue
+
+				feed = self.feeds[url]
+				keepmin = feed.get_keepmin(config)
+				for key in articles.get_expiry_candidates(url, cutoff):
+					if articles.get_feed_count(url) <= keepmin:
+						break
+					article = articles[key]
+					if not article.can_expire(now, config):
+						continue
 					call_hook("article_expired", self, config, article, now)
 					count += 1
-					feedcounts[url] -= 1
+					self.unindex_duplicates(article)
+					feed.article_expired(article, config)
+					self.feed_updated(feed)
 					del articles[key]
 			config.log("Expired ", count, " articles, leaving ", len(articles))
 
 			return count > 0
 
-		count = 0
-		for url in update_feeds:
-			count += 1
-			config.log("Updating feed ", count, " of ", numfeeds, ": ", url)
-			feed = self.feeds[url]
+		# Each feed is merged into the state as soon as it's been
+		# fetched, while the others are still being fetched.
+		deadline = None
+		if config["updatebudget"] > 0:
+			deadline = now + config["updatebudget"]
+
+		pipeline = FetchPipeline(self, update_feeds, config, deadline)
+		changed = False
+		try:
+			count = 0
+			for (url, content) in pipeline.get_results():
+				count += 1
+				config.log("Updating feed ", count, " of ", numfeeds, ": ", url)
+				feed = self.feeds[url]
 
-			if config["splitstate"]:
-				feedstate_p = persister.get(FeedState, feed.get_state_filename())
-				feedstate = feedstate_p.open()
-				articles = feedstate.articles
-			else:
-				articles = self.articles
-
-			content = fetched[url]
-			call_hook("mid_update_feed", self, config, feed, content)
-			rc = feed.update(self, now, config, articles, content)
-			url = feed.url
-			call_hook("post_update_feed", self, config, feed, rc)
-			if rc:
-				seen_some_items.add(url)
 				if config["splitstate"]:
-					feedstate.modified()
+					feedstate_p = persister.get(FeedState, feed.get_state_filename())
+					feedstate = feedstate_p.open()
+					articles = feedstate.articles
+				else:
+					articles = self.articles
+
+				call_hook("mid_update_feed", self, config, feed, content)
+				rc = feed.update(self, now, config, articles, content)
+				content = None
+				fetch_time = pipeline.fetch_times.get(url)
+				if fetch_time is not None:
+					feed.record_fetch_time(fetch_time)
+				url = feed.url
+				self.feed_updated(feed)
+				call_hook("post_update_feed", self, config, feed, rc)
+				if rc:
+					seen_some_items.add(url)
+					changed = True
 
-			if config["splitstate"]:
-				if do_expiry(articles):
-					feedstate.modified()
-				feedstate_p.close()
+				if config["splitstate"]:
+					if do_expiry(articles):
+						changed = True
+					self.set_feed_summary(feed, articles)
+					feedstate_p.close()
+
+				# If we're using a journal, save what we've done so
+				# far in case we get interrupted.
+				persister.checkpoint()
+		finally:
+			# If something's gone wrong, stop fetching.
+			pipeline.stop()
+
+		if count < numfeeds:
+			config.log("Update time budget used up; ", numfeeds - count,
+			           " feeds left until the next update")
 
 		if config["splitstate"]:
-			self.articles = {}
-		else:
-			do_expiry(self.articles)
+			self.articles = ArticleDict()
+		elif do_expiry(self.articles):
+			changed = True
 
-		self.modified()
 		config.log("Finished update")
+		return changed
 
 	def get_template(self, config, name="page"):
 		"""Return the contents of a template."""
@@ -1568,7 +3045,50 @@ __feeditems__
 	def write_article(self, f, article, config):
 		"""Write an article to the given file."""
 		feed = self.feeds[article.feed]
+
+		itembits = self.get_feed_bits(config, feed)
+		for name, value in feed.args.items():
+			if name.startswith("define_"):
+				itembits[name[7:]] = sanitise_html(value, "", True, config)
+
+		itembits.update(self.get_article_bits(config, feed, article))
+		itembits["hash"] = short_hash(article.hash)
+
+		date = article.date
+		itembits["added"] = format_time(article.added, config)
+		if date is not None:
+			itembits["date"] = format_time(date, config)
+		else:
+			itembits["date"] = ""
+
+		call_hook("output_item_bits", self, config, feed, article, itembits)
+		itemtemplate = self.get_template(config, "item")
+		f.write(fill_template(itemtemplate, itembits))
+
+	def get_article_bits(self, config, feed, article):
+		"""Get the bits that describe an article's contents, from the
+		render cache if possible."""
+		if render_cache is None:
+			return self.make_article_bits(config, feed, article)
+
+		h = hashlib.sha1()
+		hash_value(h, [render_fingerprint, feed.url,
+		               feed.args.get("format", "default"), article.hash,
+		               get_entry_digest(article)])
+		key = h.hexdigest()
+
+		bits = render_cache.get(key)
+		if bits is None:
+			bits = self.make_article_bits(config, feed, article)
+			render_cache.put(key, bits)
+		return bits
+
+	def make_article_bits(self, config, feed, article):
+		"""Generate the bits that describe an article's contents. These
+		must depend only on the fields of entry_info in ARTICLE_FIELDS,
+		and on the feed's URL and format option."""
 		entry_info = article.entry_info
+		itembits = {}
 
 		link = entry_info.get("link")
 		if link == "":
@@ -1578,11 +3098,6 @@ __feeditems__
 		if guid == "":
 			guid = None
 
-		itembits = self.get_feed_bits(config, feed)
-		for name, value in feed.args.items():
-			if name.startswith("define_"):
-				itembits[name[7:]] = sanitise_html(value, "", True, config)
-
 		title = detail_to_html(entry_info.get("title_detail"), True, config)
 
 		key = None
@@ -1596,7 +3111,6 @@ __feeditems__
 			force_preformatted = (feed.args.get("format", "default") == "text")
 			description = detail_to_html(entry_info[key], False, config, force_preformatted)
 
-		date = article.date
 		if title is None:
 			if link is None:
 				title = "Article"
@@ -1617,8 +3131,6 @@ __feeditems__
 		else:
 			itembits["title"] = '<a href="' + string_to_html(link, config) + '">' + title + '</a>'
 
-		itembits["hash"] = short_hash(article.hash)
-
 		if description is not None:
 			itembits["description"] = description
 		else:
@@ -1630,23 +3142,15 @@ __feeditems__
 		else:
 			itembits["author"] = ""
 
-		itembits["added"] = format_time(article.added, config)
-		if date is not None:
-			itembits["date"] = format_time(date, config)
-		else:
-			itembits["date"] = ""
-
-		call_hook("output_item_bits", self, config, feed, article, itembits)
-		itemtemplate = self.get_template(config, "item")
-		f.write(fill_template(itemtemplate, itembits))
+		return itembits
 
 	def write_remove_dups(self, articles, config, now):
 		"""Filter the list of articles to remove articles that are too
-		old or are duplicates."""
-		kept_articles = []
-		seen_links = set()
-		seen_guids = set()
-		dup_count = 0
+		old or are duplicates. An article is a duplicate if another
+		article with the same ID or link (or, for "similar", nearly the
+		same title and summary) was seen first, according to the
+		duplicate index, and is going to be shown."""
+		candidates = []
 		for article in articles:
 			feed = self.feeds[article.feed]
 			age = now - article.added
@@ -1654,7 +3158,13 @@ __feeditems__
 			maxage = feed.args.get("maxage", config["maxage"])
 			if maxage != 0 and age > maxage:
 				continue
+			candidates.append(article)
+		candidate_hashes = set([article.hash for article in candidates])
 
+		kept_articles = []
+		dup_count = 0
+		for article in candidates:
+			feed = self.feeds[article.feed]
 			entry_info = article.entry_info
 
 			link = entry_info.get("link")
@@ -1669,13 +3179,16 @@ __feeditems__
 				is_dup = False
 				for key in config["hideduplicates"]:
 					if key == "id" and guid is not None:
-						if guid in seen_guids:
-							is_dup = True
-						seen_guids.add(guid)
+						first = self.get_first_seen(u"id:" + guid, candidate_hashes)
 					elif key == "link" and link is not None:
-						if link in seen_links:
-							is_dup = True
-						seen_links.add(link)
+						first = self.get_first_seen(u"link:" + link, candidate_hashes)
+					elif key == "similar":
+						first = self.get_similar(article, candidate_hashes)
+					else:
+						continue
+					if first is not None and first != article.hash:
+						is_dup = True
+						break
 				if is_dup:
 					dup_count += 1
 					continue
@@ -1686,16 +3199,21 @@ __feeditems__
 	def get_feed_bits(self, config, feed):
 		"""Get the bits that are used to describe a feed."""
 
-		bits = {}
-		bits["feed_id"] = feed.get_id(config)
-		bits["feed_hash"] = short_hash(feed.url)
-		bits["feed_title"] = feed.get_html_link(config)
-		bits["feed_title_no_link"] = detail_to_html(feed.feed_info.get("title_detail"), True, config)
-		bits["feed_url"] = string_to_html(feed.url, config)
-		bits["feed_icon"] = '<a class="xmlbutton" href="' + cgi.escape(feed.url) + '">XML</a>'
-		bits["feed_last_update"] = format_time(feed.last_update, config)
-		bits["feed_next_update"] = format_time(feed.last_update + feed.period, config)
-		return bits
+		bits = feed_bits_cache.get(feed.url)
+		if bits is None:
+			html = feed.get_html_bits(config)
+			bits = {}
+			bits["feed_id"] = feed.get_id(config)
+			bits["feed_hash"] = short_hash(feed.url)
+			bits["feed_title"] = html["link"]
+			bits["feed_title_no_link"] = html["title"]
+			bits["feed_url"] = html["url"]
+			bits["feed_icon"] = '<a class="xmlbutton" href="' + cgi.escape(feed.url) + '">XML</a>'
+			bits["feed_last_update"] = format_time(feed.last_update, config)
+			bits["feed_next_update"] = format_time(feed.get_next_update(), config)
+			feed_bits_cache[feed.url] = bits
+		# The caller may change the bits.
+		return bits.copy()
 
 	def write_feeditem(self, f, feed, config):
 		"""Write a feed list item."""
@@ -1736,9 +3254,8 @@ __feeditems__
 
 		return bits
 
-	def write_output_file(self, articles, article_dates, config):
-		"""Write a regular rawdog HTML output file."""
-		f = StringIO()
+	def write_items(self, f, articles, article_dates, config):
+		"""Write the articles to the given file."""
 		dw = DayWriter(f, config)
 		call_hook("output_items_begin", self, config, f)
 
@@ -1751,44 +3268,138 @@ __feeditems__
 		dw.close()
 		call_hook("output_items_end", self, config, f)
 
+	def write_output_file(self, articles, article_dates, config):
+		"""Write a regular rawdog HTML output file."""
+		template = self.get_template(config, "page")
+
+		# If nothing needs to see the complete page, then write the
+		# items straight to the output file as they're generated,
+		# rather than building the page in memory first.
+		items_index = None
+		if attached.get("output_bits", []) == [] and attached.get("fill_template", []) == []:
+			items_index = find_template_bit(template, "items")
+
 		bits = self.get_main_template_bits(config)
-		bits["items"] = f.getvalue()
-		f.close()
 		bits["num_items"] = str(len(articles))
-		call_hook("output_bits", self, config, bits)
-		s = fill_template(self.get_template(config, "page"), bits)
+		if items_index is None:
+			f = StringIO()
+			self.write_items(f, articles, article_dates, config)
+			bits["items"] = f.getvalue()
+			f.close()
+			call_hook("output_bits", self, config, bits)
+			s = fill_template(template, bits)
+
 		outputfile = config["outputfile"]
 		if outputfile == "-":
-			write_ascii(sys.stdout, s, config)
+			f = sys.stdout
 		else:
 			config.log("Writing output file: ", outputfile)
 			f = open(outputfile + ".new", "w")
+
+		if items_index is None:
 			write_ascii(f, s, config)
+		else:
+			program = get_compiled_template(template)
+			write_ascii(f, expand_template(program, bits, 0, items_index), config)
+			self.write_items(f, articles, article_dates, config)
+			write_ascii(f, expand_template(program, bits, items_index + 1, len(program)), config)
+
+		if outputfile != "-":
 			f.close()
 			os.rename(outputfile + ".new", outputfile)
 
-	def write(self, config):
+	def get_output_fingerprint(self, config, articles, article_dates):
+		"""Return a string that will be different if writing these
+		articles might produce different output from last time."""
+		h = hashlib.sha1()
+		hash_value(h, [VERSION, time.strftime("%Y-%m-%d %z"),
+		               locale.setlocale(locale.LC_TIME), config.config])
+		names = ["page", "item"]
+		if config["showfeeds"]:
+			names += ["feedlist", "feeditem"]
+		# Feeds' update times only matter if they're shown.
+		show_updates = False
+		for name in names:
+			template = self.get_template(config, name)
+			hash_value(h, template)
+			if "feed_last_update" in template or "feed_next_update" in template:
+				show_updates = True
+		hash_hooks(h, sorted(attached.keys()))
+		for url in sorted(self.feeds.keys()):
+			feed = self.feeds[url]
+			hash_value(h, [url, feed.period, feed.args,
+			               feed.feed_info.get("title_detail"),
+			               feed.feed_info.get("link")])
+			if show_updates:
+				hash_value(h, [feed.last_update, feed.get_next_update()])
+		for article in articles:
+			hash_value(h, [article.hash, article.feed, article.added,
+			               article.date, article_dates[article],
+			               get_entry_digest(article)])
+		return h.hexdigest()
+
+	def write(self, config, force=False):
 		"""Perform the write action: write articles to the output
-		file."""
+		file. Unless force is True, the output won't be written if
+		nothing that affects it has changed since last time."""
 		config.log("Starting write")
 		now = time.time()
 
-		def list_articles(articles):
-			return [(-a.get_sort_date(config), a.feed, a.sequence, a.hash) for a in articles.values()]
-		if config["splitstate"]:
-			article_list = []
-			for feed in self.feeds.values():
-				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
-					article_list += list_articles(feedstate.articles)
+		global render_cache, render_fingerprint
+		feed_bits_cache.clear()
+		if config["rendercachesize"] > 0:
+			render_cache_p = persister.get(RenderCache, "rendercache")
+			render_cache = render_cache_p.open()
+		if render_cache is not None:
+			render_cache.start()
+			render_fingerprint = get_render_fingerprint(config)
+
+		# If nothing else wants to sort the articles, then we only
+		# need to find the first maxarticles, not sort them all.
+		maxarticles = config["maxarticles"]
+		top_only = (maxarticles != 0
+		            and attached.get("output_sort_articles", []) == [])
+
+		def list_articles(feed, l):
+			"""Given sort keys for the articles from a feed, return
+			the ones that might be shown."""
+			limit = feed.args.get("maxarticles", 0)
+			if top_only and (limit == 0 or limit > maxarticles):
+				limit = maxarticles
+			if limit != 0 and limit < len(l):
+				l = heapq.nsmallest(limit, l)
+			return l
+
+		# With split state files, the articles are chosen using the
+		# index, so only the state files containing articles that
+		# will be written need to be loaded.
+		index = self.get_article_index()
+		article_list = []
+		numarticles = 0
+		for feed in self.feeds.values():
+			if config["splitstate"]:
+				if feed.url not in index:
+					with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+						self.set_feed_summary(feed, feedstate.articles)
+				summary = index[feed.url]
+				keys = [(-get_sort_date(date, added, config), feed.url, seq, hash)
+				        for (hash, (date, added, seq, last_seen)) in summary.items()]
+			else:
+				keys = []
+				for hash in self.articles.get_feed_hashes(feed.url):
+					a = self.articles[hash]
+					keys.append((-a.get_sort_date(config), a.feed, a.sequence, hash))
+			numarticles += len(keys)
+			article_list += list_articles(feed, keys)
+
+		if top_only:
+			article_list = heapq.nsmallest(maxarticles, article_list)
 		else:
-			article_list = list_articles(self.articles)
-		numarticles = len(article_list)
+			if not call_hook("output_sort_articles", self, config, article_list):
+				article_list.sort()
 
-		if not call_hook("output_sort_articles", self, config, article_list):
-			article_list.sort()
-
-		if config["maxarticles"] != 0:
-			article_list = article_list[:config["maxarticles"]]
+			if maxarticles != 0:
+				article_list = article_list[:maxarticles]
 
 		if config["splitstate"]:
 			wanted = {}
@@ -1807,7 +3418,14 @@ __feeditems__
 				feed = self.feeds[feed_url]
 				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
 					for hash in article_hashes:
-						found[hash] = feedstate.articles[hash]
+						article = feedstate.articles.get(hash)
+						if article is None:
+							# The index is out of date, probably
+							# because rawdog was killed during an
+							# update; it'll be right next time.
+							self.set_feed_summary(feed, feedstate.articles)
+						else:
+							found[hash] = article
 		else:
 			found = self.articles
 
@@ -1828,9 +3446,34 @@ __feeditems__
 
 		config.log("Selected ", len(articles), " of ", numarticles, " articles to write; ignored ", dup_count, " duplicates")
 
-		if not call_hook("output_write_files", self, config, articles, article_dates):
+		outputfile = config["outputfile"]
+		fingerprint = None
+		unchanged = False
+		if outputfile != "-":
+			output_record_p = persister.get(OutputRecord, "outputs")
+			output_record = output_record_p.open()
+			fingerprint = self.get_output_fingerprint(config, articles, article_dates)
+			if (not force
+			    and output_record.get_output(outputfile) == fingerprint
+			    and os.path.exists(outputfile)):
+				skip = Box(True)
+				call_hook("output_unchanged", self, config, skip)
+				unchanged = skip.value
+
+		if unchanged:
+			config.log("Output unchanged; not writing")
+		elif not call_hook("output_write_files", self, config, articles, article_dates):
 			self.write_output_file(articles, article_dates, config)
 
+		if fingerprint is not None:
+			output_record.set_output(outputfile, fingerprint)
+			output_record_p.close()
+
+		if render_cache is not None:
+			render_cache.trim(config["rendercachesize"])
+			render_cache_p.close()
+			render_cache = None
+
 		config.log("Finished write")
 
 def usage():
@@ -1844,6 +3487,9 @@ General options (use only once):
 -v, --verbose                Print more detailed status information
 -V|--log FILE                Append detailed status information to FILE
 -W, --no-lock-wait           Exit silently if state file is locked
+--daemon                     After performing any actions, keep running,
+                             updating feeds and writing output as needed
+--max-runtime TIME           Don't start fetching more feeds after TIME
 
 Actions (performed in order given):
 -a|--add URL                 Try to find a feed associated with URL and
@@ -1856,6 +3502,8 @@ Actions (performed in order given):
                              (TEMPLATE may be: page item feedlist feeditem)
 -u, --update                 Fetch data from feeds and store it
 -w, --write                  Write out HTML output
+--force-write                Write out HTML output, even if nothing has
+                             changed since it was last written
 
 Special actions (all other options are ignored if one of these is specified):
 --dump URL                   Show what rawdog's parser returns for URL
@@ -1878,11 +3526,14 @@ def main(argv):
 		LONGOPTS = [
 			"add=",
 			"config=",
+			"daemon",
 			"dir=",
 			"dump=",
+			"force-write",
 			"help",
 			"list",
 			"log=",
+			"max-runtime=",
 			"no-lock-wait",
 			"no-locking",
 			"remove=",
@@ -1912,6 +3563,8 @@ def main(argv):
 	logfile_name = None
 	locking = True
 	no_lock_wait = False
+	max_runtime = None
+	daemon = False
 	for o, a in optlist:
 		if o == "--dump":
 			import pprint
@@ -1930,6 +3583,14 @@ def main(argv):
 			logfile_name = a
 		elif o in ("-W", "--no-lock-wait"):
 			no_lock_wait = True
+		elif o == "--daemon":
+			daemon = True
+		elif o == "--max-runtime":
+			try:
+				max_runtime = parse_time(a)
+			except ValueError:
+				print "Bad time for --max-runtime: " + a
+				return 1
 	if statedir is None:
 		print "$HOME not set and state dir not explicitly specified; please use -d/--dir"
 		return 1
@@ -1943,6 +3604,11 @@ def main(argv):
 	sys.path.append(".")
 
 	config = Config(locking, logfile_name)
+	def apply_options():
+		if verbose:
+			config["verbose"] = True
+		if max_runtime is not None:
+			config["updatebudget"] = max_runtime
 	def load_config(fn):
 		try:
 			config.load(fn)
@@ -1950,15 +3616,45 @@ def main(argv):
 			print >>sys.stderr, "In " + fn + ":"
 			print >>sys.stderr, err
 			return 1
-		if verbose:
-			config["verbose"] = True
+		apply_options()
 		return 0
+	def reload_config():
+		old_config = config.config
+		try:
+			config.reload()
+		except ConfigError, err:
+			print >>sys.stderr, "Error reloading config; keeping the old config:"
+			print >>sys.stderr, err
+			config.config = old_config
+			return
+		apply_options()
+		rawdog.sync_from_config(config)
 	rc = load_config("config")
 	if rc != 0:
 		return rc
 
+	# If there's a daemon running, then it has the state locked, so
+	# leave everything to it.
+	pidfile = None
+	if daemon:
+		pidfile = PidFile(PIDFILE)
+		if not pidfile.acquire():
+			print "rawdog is already running as a daemon (process " + str(get_daemon_pid(PIDFILE)) + ")"
+			return 1
+	elif locking:
+		pid = get_daemon_pid(PIDFILE)
+		if pid is not None:
+			config.log("rawdog is running as a daemon (process ", pid, "); not doing anything")
+			return 0
+
 	global persister
-	persister = Persister(config)
+	if config["statebackend"] == "sqlite":
+		if SQLitePersister is None:
+			print >>sys.stderr, "statebackend sqlite requires Python's sqlite3 module"
+			return 1
+		persister = SQLitePersister(config)
+	else:
+		persister = Persister(config)
 
 	rawdog_p = persister.get(Rawdog, "state")
 	rawdog = rawdog_p.open(no_block=no_lock_wait)
@@ -1978,6 +3674,7 @@ def main(argv):
 		if o in ("-a", "--add"):
 			add_feed("config", a, rawdog, config)
 			config.reload()
+			apply_options()
 			rawdog.sync_from_config(config)
 		elif o in ("-c", "--config"):
 			rc = load_config(a)
@@ -1991,6 +3688,7 @@ def main(argv):
 		elif o in ("-r", "--remove"):
 			remove_feed("config", a, config)
 			config.reload()
+			apply_options()
 			rawdog.sync_from_config(config)
 		elif o in ("-s", "--show"):
 			rawdog.show_template(a, config)
@@ -2002,9 +3700,24 @@ def main(argv):
 			rawdog.update(config)
 		elif o in ("-w", "--write"):
 			rawdog.write(config)
+		elif o == "--force-write":
+			rawdog.write(config, True)
+
+	if daemon:
+		# Keep the render cache loaded between writes.
+		render_cache_p = None
+		if config["rendercachesize"] > 0:
+			render_cache_p = persister.get(RenderCache, "rendercache")
+			render_cache_p.open()
+		Daemon(rawdog, config, persister, reload_config).run()
+		if render_cache_p is not None:
+			render_cache_p.close()
 
 	call_hook("shutdown", rawdog, config)
 
 	rawdog_p.close()
 
+	if pidfile is not None:
+		pidfile.release()
+
 	return 0
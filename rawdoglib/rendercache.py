@@ -0,0 +1,83 @@
+# rendercache: cache the HTML that rawdog generates between runs
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+from rawdoglib.persister import Persistable
+
+import heapq
+
+class RenderCache(Persistable):
+	"""A cache of HTML that rawdog has generated, so that it doesn't need
+	to be sanitised again each time the output is written. Entries are
+	looked up by a key that should change whenever the HTML would; the
+	least recently used entries are thrown away when the cache is
+	trimmed."""
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.entries = {}
+		self.clock = 0
+
+	def start(self):
+		"""Start a new run. Entries used during this run will be kept in
+		preference to those that weren't."""
+		self.clock += 1
+
+	def get(self, key):
+		"""Return the value stored for key, or None if there isn't
+		one."""
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		# Just using an entry doesn't make the cache worth saving.
+		entry[0] = self.clock
+		return entry[1]
+
+	def put(self, key, value):
+		"""Store a value in the cache."""
+		self.entries[key] = [self.clock, value]
+		self.modified()
+
+	def trim(self, size):
+		"""Remove the least recently used entries so that no more than
+		size remain."""
+		if len(self.entries) <= size:
+			return
+		keep = heapq.nlargest(size, self.entries.items(),
+		                      key=lambda item: item[1][0])
+		self.entries = dict(keep)
+		self.modified()
+
+class OutputRecord(Persistable):
+	"""A record of a fingerprint of the last output written to each
+	output file, so that writing it again can be skipped if nothing has
+	changed."""
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.outputs = {}
+
+	def get_output(self, filename):
+		"""Return the fingerprint recorded for the last output written to
+		filename, or None if there isn't one."""
+		return self.outputs.get(filename)
+
+	def set_output(self, filename, fingerprint):
+		"""Record the fingerprint of the output written to filename."""
+		if self.outputs.get(filename) != fingerprint:
+			self.outputs[filename] = fingerprint
+			self.modified()
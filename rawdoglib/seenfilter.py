@@ -0,0 +1,92 @@
+# seenfilter: remember keys compactly using a rotating Bloom filter
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+import hashlib
+import math
+import struct
+
+# The proportion of keys that a full filter will wrongly claim to
+# contain.
+FALSE_POSITIVE_RATE = 0.0001
+
+class SeenFilter:
+	"""A set of strings that takes a fixed amount of space, however many
+	are added to it. It always remembers the last capacity strings added
+	to it, and may remember up to capacity more; once it's full, the
+	oldest half is forgotten.
+
+	This is done using two Bloom filters: new strings are added to the
+	current one, and when that's full, it replaces the previous one. A
+	Bloom filter may wrongly claim to contain a string it was never
+	given, with probability FALSE_POSITIVE_RATE when it's full."""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		num_bits = -capacity * math.log(FALSE_POSITIVE_RATE) / (math.log(2) ** 2)
+		self.num_bits = max(int(math.ceil(num_bits)), 8)
+		self.num_hashes = max(int(round(self.num_bits * math.log(2) / capacity)), 1)
+		self.current = self.make_bits()
+		self.previous = None
+		self.count = 0
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for name in ("current", "previous"):
+			if state[name] is not None:
+				state[name] = str(state[name])
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		for name in ("current", "previous"):
+			if state[name] is not None:
+				setattr(self, name, bytearray(state[name]))
+
+	def make_bits(self):
+		return bytearray((self.num_bits + 7) // 8)
+
+	def get_positions(self, key):
+		"""Return the bits that represent a string."""
+		digest = hashlib.sha1(key.encode("UTF-8")).digest()
+		(h1, h2) = struct.unpack("<QQ", digest[:16])
+		return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+	def contains_positions(self, bits, positions):
+		for pos in positions:
+			if not (bits[pos >> 3] & (1 << (pos & 7))):
+				return False
+		return True
+
+	def __contains__(self, key):
+		positions = self.get_positions(key)
+		if self.contains_positions(self.current, positions):
+			return True
+		return (self.previous is not None
+		        and self.contains_positions(self.previous, positions))
+
+	def add(self, key):
+		"""Add a string to the filter."""
+		if key in self:
+			return
+		if self.count >= self.capacity:
+			self.previous = self.current
+			self.current = self.make_bits()
+			self.count = 0
+		for pos in self.get_positions(key):
+			self.current[pos >> 3] |= 1 << (pos & 7)
+		self.count += 1
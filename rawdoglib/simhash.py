@@ -0,0 +1,83 @@
+# simhash: find articles that are nearly the same as each other
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+"""Compute SimHash signatures of text.
+
+A signature is a 64-bit number where each bit is the majority vote of
+the corresponding bit of the hashes of the words in the text, so texts
+that share most of their words have signatures that differ in only a
+few bits.
+
+To find similar signatures without comparing every pair, each signature
+is split into BANDS pieces. Two signatures that differ in fewer than
+BANDS bits must have at least one piece in common, so only signatures
+that share a piece need comparing."""
+
+import hashlib
+import re
+
+# The number of bits in a signature.
+BITS = 64
+
+# The number of pieces each signature is split into for indexing.
+BANDS = 4
+
+# The most bits in which two signatures can differ for their texts to be
+# considered the same.
+MAX_DISTANCE = BANDS - 1
+
+tag_re = re.compile(r'<[^>]*>')
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def get_words(text):
+	"""Return the words in a piece of text, which may contain HTML."""
+	return word_re.findall(tag_re.sub(" ", text).lower())
+
+def compute_simhash(text):
+	"""Return the signature of a piece of text, or None if it doesn't
+	contain any words."""
+	words = get_words(text)
+	if words == []:
+		return None
+
+	votes = [0] * BITS
+	for word in set(words):
+		h = int(hashlib.md5(word.encode("UTF-8")).hexdigest()[:BITS / 4], 16)
+		for i in range(BITS):
+			if h & (1 << i):
+				votes[i] += 1
+			else:
+				votes[i] -= 1
+
+	signature = 0
+	for i in range(BITS):
+		if votes[i] > 0:
+			signature |= 1 << i
+	return signature
+
+def get_bands(signature):
+	"""Return a list of the pieces of a signature, as strings that can be
+	used as index keys."""
+	width = BITS / BANDS
+	mask = (1 << width) - 1
+	return ["%d:%x" % (i, (signature >> (i * width)) & mask)
+	        for i in range(BANDS)]
+
+def get_distance(a, b):
+	"""Return the number of bits in which two signatures differ."""
+	return bin(a ^ b).count("1")
@@ -0,0 +1,311 @@
+# sqlpersister: persist rawdog's state in an SQLite database
+# Copyright 2016 Adam Sampson <ats@offog.org>
+#
+# rawdog is free software; you can redistribute and/or modify it
+# under the terms of that license as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# rawdog is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rawdog; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA, or see http://www.gnu.org/.
+
+from rawdoglib.persister import Persisted, Persister
+
+import cPickle as pickle
+import errno
+import fcntl
+import os
+import sqlite3
+
+# Each persisted object gets a row in the objects table, named after the file
+# it would be stored in by the pickle persister. Dictionary attributes that
+# can get large are stored one entry per row instead, in these tables, so that
+# only the entries that have changed need to be rewritten.
+ROW_TABLES = {
+	"feeds": "feeds",
+	"plugin_storage": "plugin_storage",
+	"article_index": "article_index",
+	"dup_index": "dup_index",
+	}
+
+# The change records returned by get_changes that describe a single row in
+# one of the ROW_TABLES: (record type, key, new value), where the value is
+# None if the row has been deleted. "articles" records are handled
+# separately.
+CHANGE_TABLES = {
+	"feed": "feeds",
+	"summary": "article_index",
+	"dups": "dup_index",
+	}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+	name TEXT PRIMARY KEY,
+	data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS feeds (
+	name TEXT NOT NULL,
+	key TEXT NOT NULL,
+	data BLOB NOT NULL,
+	PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS plugin_storage (
+	name TEXT NOT NULL,
+	key TEXT NOT NULL,
+	data BLOB NOT NULL,
+	PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS article_index (
+	name TEXT NOT NULL,
+	key TEXT NOT NULL,
+	data BLOB NOT NULL,
+	PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS dup_index (
+	name TEXT NOT NULL,
+	key TEXT NOT NULL,
+	data BLOB NOT NULL,
+	PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS articles (
+	name TEXT NOT NULL,
+	hash TEXT NOT NULL,
+	feed TEXT NOT NULL,
+	guid TEXT,
+	data BLOB NOT NULL,
+	PRIMARY KEY (name, hash)
+);
+CREATE INDEX IF NOT EXISTS articles_feed_guid ON articles (feed, guid);
+"""
+
+def dumps(obj):
+	return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+	return pickle.loads(str(data))
+
+class SQLitePersisted(Persisted):
+	"""Context manager for a persistent object stored in an SQLite
+	database. The object's articles, and the entries in any of its
+	ROW_TABLES attributes, are stored as separate rows. When the object
+	is saved, only the rows named by its get_changes records are written
+	back; if it can't describe its changes that way, all its rows are
+	compared against the database.
+
+	If the object isn't in the database yet, but the pickle persister has
+	a file for it, then the object is imported from that file."""
+
+	def __init__(self, klass, filename, persister):
+		Persisted.__init__(self, klass, filename, persister)
+		self.saved_state = None
+
+	def get_path(self):
+		return os.path.abspath(self.persister.filename)
+
+	def rename(self, new_filename):
+		self.persister._rename(self.filename, new_filename)
+		db = self.persister.connect(False)
+		for table in ["objects", "articles"] + ROW_TABLES.values():
+			db.execute("UPDATE " + table + " SET name = ? WHERE name = ?",
+			           (new_filename, self.filename))
+		db.commit()
+		try:
+			os.rename(self.filename, new_filename)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise e
+		self.filename = new_filename
+
+	def _open(self, no_block):
+		self.persister.log("Loading state from database: ", self.filename)
+
+		db = self.persister.connect(no_block)
+		if db is None:
+			return None
+
+		row = db.execute("SELECT data FROM objects WHERE name = ?",
+		                 (self.filename,)).fetchone()
+		if row is None:
+			self.saved_state = None
+			self.object = self._import()
+			self.object.modified()
+			return
+
+		self.saved_state = str(row[0])
+		self.object = self.klass()
+		self.object.__dict__.update(loads(row[0]))
+
+		for attr, table in ROW_TABLES.items():
+			if not attr in self.object.__dict__:
+				continue
+			values = {}
+			for key, data in db.execute("SELECT key, data FROM " + table + " WHERE name = ?", (self.filename,)):
+				values[key] = loads(data)
+			setattr(self.object, attr, values)
+
+		if "articles" in self.object.__dict__:
+			for hash, data in db.execute("SELECT hash, data FROM articles WHERE name = ?", (self.filename,)):
+				self.object.articles[hash] = loads(data)
+
+		self.object.modified(False)
+
+	def _import(self):
+		"""Load the object from the pickle persister's file if there is
+		one, or create a new object if not."""
+		try:
+			f = open(self.filename, "rb")
+		except IOError:
+			return self.klass()
+		self.persister.log("Importing state file: ", self.filename)
+		obj = pickle.load(f)
+		f.close()
+		return obj
+
+	def save_in_background(self):
+		# SQLite connections can't be shared between threads, and
+		# only the rows that have changed need writing anyway, so
+		# just save it now.
+		if self.refcount > 0 and self.object.is_modified():
+			self._save()
+
+	def _save(self):
+		self.persister.log("Saving state to database: ", self.filename)
+
+		db = self.persister.db
+		changes = self.object.get_changes()
+		self.object.modified(False)
+		state = self.object.__dict__.copy()
+		del state["_modified"]
+
+		all_rows = {}
+		for attr, table in ROW_TABLES.items():
+			if attr in state:
+				all_rows[table] = state.pop(attr)
+		articles = state.pop("articles", None)
+
+		if changes is None:
+			for table, values in all_rows.items():
+				self._save_all_rows(db, table, values)
+			if articles is not None:
+				self._save_all_articles(db, articles)
+		else:
+			for change in changes:
+				if change[0] == "articles":
+					for hash, article in change[1].items():
+						self._save_article(db, hash, article)
+				else:
+					self._save_row(db, CHANGE_TABLES[change[0]],
+					               change[1], change[2])
+
+		data = dumps(state)
+		if data != self.saved_state:
+			db.execute("INSERT OR REPLACE INTO objects (name, data) VALUES (?, ?)",
+			           (self.filename, sqlite3.Binary(data)))
+			self.saved_state = data
+
+		db.commit()
+
+	def _save_row(self, db, table, key, value):
+		"""Store a row, or delete it if value is None."""
+		if value is None:
+			db.execute("DELETE FROM " + table + " WHERE name = ? AND key = ?",
+			           (self.filename, key))
+		else:
+			db.execute("INSERT OR REPLACE INTO " + table + " (name, key, data) VALUES (?, ?, ?)",
+			           (self.filename, key, sqlite3.Binary(dumps(value))))
+
+	def _save_article(self, db, hash, article):
+		"""Store an article, or delete it if article is None."""
+		if article is None:
+			db.execute("DELETE FROM articles WHERE name = ? AND hash = ?",
+			           (self.filename, hash))
+		else:
+			db.execute("INSERT OR REPLACE INTO articles (name, hash, feed, guid, data) VALUES (?, ?, ?, ?, ?)",
+			           (self.filename, hash, article.feed,
+			            article.entry_info.get("id"),
+			            sqlite3.Binary(dumps(article))))
+
+	def _save_all_rows(self, db, table, values):
+		"""Make a table's rows match a dictionary, writing only the rows
+		that differ."""
+		saved = {}
+		for key, data in db.execute("SELECT key, data FROM " + table + " WHERE name = ?", (self.filename,)):
+			saved[key] = str(data)
+		for key, value in values.items():
+			data = dumps(value)
+			if saved.pop(key, None) != data:
+				db.execute("INSERT OR REPLACE INTO " + table + " (name, key, data) VALUES (?, ?, ?)",
+				           (self.filename, key, sqlite3.Binary(data)))
+		for key in saved.keys():
+			self._save_row(db, table, key, None)
+
+	def _save_all_articles(self, db, articles):
+		"""Make the articles table match a dictionary of articles,
+		writing only the articles that differ."""
+		saved = {}
+		for hash, data in db.execute("SELECT hash, data FROM articles WHERE name = ?", (self.filename,)):
+			saved[hash] = str(data)
+		for hash, article in articles.items():
+			data = dumps(article)
+			if saved.pop(hash, None) != data:
+				db.execute("INSERT OR REPLACE INTO articles (name, hash, feed, guid, data) VALUES (?, ?, ?, ?, ?)",
+				           (self.filename, hash, article.feed,
+				            article.entry_info.get("id"),
+				            sqlite3.Binary(data)))
+		for hash in saved.keys():
+			self._save_article(db, hash, None)
+
+class SQLitePersister(Persister):
+	"""Manage a collection of persisted objects stored in a single SQLite
+	database. The database is locked for as long as rawdog is using it."""
+
+	persisted_class = SQLitePersisted
+
+	def __init__(self, config, filename="state.sqlite"):
+		Persister.__init__(self, config)
+		self.filename = filename
+		self.lock_file = None
+		self.db = None
+
+	def connect(self, no_block):
+		"""Return a connection to the database, opening it if it isn't
+		already open. If no_block is True, then return None if the
+		database is locked by another process."""
+
+		if self.db is not None:
+			return self.db
+
+		if self.use_locking:
+			self.lock_file = open(self.filename + ".lock", "w+")
+			try:
+				mode = fcntl.LOCK_EX
+				if no_block:
+					mode |= fcntl.LOCK_NB
+				fcntl.lockf(self.lock_file.fileno(), mode)
+			except IOError, e:
+				self.lock_file.close()
+				self.lock_file = None
+				if no_block and e.errno in (errno.EACCES, errno.EAGAIN):
+					return None
+				raise e
+
+		self.db = sqlite3.connect(self.filename)
+		self.db.executescript(SCHEMA)
+		return self.db
+
+	def delete(self, filename):
+		"""Delete a persisted object from the database, along with any
+		file left for it by the pickle persister."""
+		db = self.connect(False)
+		for table in ["objects", "articles"] + ROW_TABLES.values():
+			db.execute("DELETE FROM " + table + " WHERE name = ?",
+			           (filename,))
+		db.commit()
+		Persister.delete(self, filename)
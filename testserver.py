@@ -117,6 +117,21 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             self.end_headers()
             return None
 
+        max_age = None
+        m = re.match(r'^/maxage-(\d+)(/.*)$', self.path)
+        if m:
+            # Request for a Cache-Control max-age.
+            max_age = m.group(1)
+            self.path = m.group(2)
+
+        send_etag = True
+        m = re.match(r'^/noetag(/.*)$', self.path)
+        if m:
+            # Request for a server that doesn't support conditional
+            # requests.
+            send_etag = False
+            self.path = m.group(1)
+
         encoding = None
         m = re.match(r'^/(gzip)(/.*)$', self.path)
         if m:
@@ -140,7 +155,7 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             f.seek(0)
 
             # Oversimplistic, but matches what feedparser sends.
-            if self.headers.get("If-None-Match", "") == etag:
+            if send_etag and self.headers.get("If-None-Match", "") == etag:
                 self.send_response(304)
                 self.end_headers()
                 return None
@@ -173,7 +188,10 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
             self.send_header("Content-Length", size)
             self.send_header("Content-Type", mime_type)
-            self.send_header("ETag", etag)
+            if send_etag:
+                self.send_header("ETag", etag)
+            if max_age is not None:
+                self.send_header("Cache-Control", "max-age=" + max_age)
             self.end_headers()
             return f
 